@@ -0,0 +1,282 @@
+"""
+End-to-end FTPServer benchmarks on the host, over loopback.
+
+    python bench/bench_ftp.py [--mb 4] [--files 10000] [--clients 4] [--depth 2]
+                              [--save bench/results/name.json]
+                              [--compare bench/results/old.json]
+
+The server runs unmodified in its own asyncio thread against a temporary
+directory, with the machine/network/micropython stand-ins from bench/stubs;
+clients are ftplib. Numbers are host numbers: they track relative changes in
+the server's own overhead (parsing, buffering, hashing, index), not RP2040
+throughput. The sd_* figures come from bench_sdcard on the simulated SPI card
+and are modelled device time. --save writes the results as JSON and --compare
+prints the change against an earlier run.
+"""
+
+import argparse
+import asyncio
+import ftplib
+import hashlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import host
+
+host.install()
+import bench_sdcard
+from logger import Logger
+from ftpserver import FTPServer
+from tamper import FileTamper, TamperScanner
+from transfer import DEFAULT_PIPELINE_DEPTH
+
+USER = "bench"
+PASSWORD = "bench"
+PASV_PORTS = 8
+
+
+def free_port_range(count):
+    # First base port in 40000..60000 with count consecutive free ports.
+    for base in range(40000, 60000, count):
+        socks = []
+        try:
+            for port in range(base, base + count):
+                s = socket.socket()
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                socks.append(s)
+                s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for s in socks:
+                s.close()
+    raise RuntimeError("no free port range")
+
+
+class BenchServer:
+    def __init__(self, root, **kwargs):
+        base = free_port_range(PASV_PORTS + 1)
+        self.port = base
+        self.ftp = FTPServer(USER, PASSWORD, port=base, pasv_port_start=base + 1,
+                             pasv_port_count=PASV_PORTS, root=root, **kwargs)
+        self.ftp.set_local_ip("127.0.0.1")
+        self.ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        if not self.ready.wait(10):
+            raise RuntimeError("server did not start")
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._main())
+
+    async def _main(self):
+        await self.ftp.start()
+        self.ready.set()
+        await self.ftp.serve_forever()
+
+    def client(self):
+        c = ftplib.FTP()
+        c.connect("127.0.0.1", self.port, timeout=60)
+        c.login(USER, PASSWORD)
+        return c
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.ftp.stop)
+        self.thread.join(10)
+
+
+class Sink:
+    def __init__(self):
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def __call__(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+
+
+def mib_per_s(nbytes, seconds):
+    return nbytes / (1 << 20) / max(seconds, 1e-9)
+
+
+def bench_transfer(server, mbytes):
+    payload = os.urandom(mbytes << 20)
+    c = server.client()
+    start = time.perf_counter()
+    c.storbinary("STOR transfer.bin", io.BytesIO(payload), blocksize=65536)
+    stor_s = time.perf_counter() - start
+    sink = Sink()
+    start = time.perf_counter()
+    c.retrbinary("RETR transfer.bin", sink, blocksize=65536)
+    retr_s = time.perf_counter() - start
+    c.quit()
+    if sink.hash.digest() != hashlib.sha1(payload).digest():
+        raise RuntimeError("RETR returned different data")
+    return {
+        "stor_MiBps": mib_per_s(len(payload), stor_s),
+        "retr_MiBps": mib_per_s(len(payload), retr_s),
+    }
+
+
+def bench_list(root, nfiles):
+    for i in range(nfiles):
+        open(os.path.join(root, "f%05d.txt" % i), "wb").close()
+    server = BenchServer(root)
+    try:
+        c = server.client()
+        results = {}
+        for key, cmd in (("nlst_cold_ms", "NLST"), ("nlst_warm_ms", "NLST"),
+                         ("mlsd_warm_ms", "MLSD")):
+            lines = []
+            start = time.perf_counter()
+            c.retrlines(cmd, lines.append)
+            results[key] = (time.perf_counter() - start) * 1000
+            if len(lines) < nfiles:
+                raise RuntimeError("%s listed %d of %d files" % (cmd, len(lines), nfiles))
+        c.quit()
+    finally:
+        server.stop()
+    return results
+
+
+def bench_scan(root, nfiles, kib):
+    FileTamper.set_root(root)
+    data = os.urandom(kib * 1024)
+    for i in range(nfiles):
+        path = "%s/scan%03d.bin" % (root, i)
+        with open(path, "wb") as f:
+            f.write(data)
+        FileTamper.init_file_hash(path)
+    scanner = TamperScanner()
+    ticks = 0
+    worst = 0
+    start = time.perf_counter()
+    while not scanner.cycles:
+        t = time.perf_counter()
+        scanner.tick()
+        worst = max(worst, time.perf_counter() - t)
+        ticks += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "scan_MiBps": mib_per_s(nfiles * len(data), elapsed),
+        "scan_ticks": ticks,
+        "scan_worst_tick_ms": worst * 1000,
+    }
+
+
+def bench_concurrent(server, clients, mbytes):
+    payload = os.urandom(mbytes << 20)
+    barrier = threading.Barrier(clients)
+    times = [None] * clients
+    errors = []
+
+    def worker(i):
+        try:
+            c = server.client()
+            barrier.wait()
+            start = time.perf_counter()
+            name = "client%d.bin" % i
+            c.storbinary("STOR " + name, io.BytesIO(payload), blocksize=65536)
+            sink = Sink()
+            c.retrbinary("RETR " + name, sink, blocksize=65536)
+            times[i] = time.perf_counter() - start
+            c.quit()
+            if sink.size != len(payload):
+                errors.append("client %d got %d bytes" % (i, sink.size))
+        except Exception as e:
+            errors.append("client %d: %s" % (i, e))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    if errors:
+        raise RuntimeError("; ".join(errors))
+    return {
+        "concurrent_MiBps": mib_per_s(2 * clients * len(payload), wall),
+        "concurrent_slowest_s": max(times),
+    }
+
+
+def run(args):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="ftpbench") as tmp:
+        Logger.init(os.path.join(tmp, "bench.log"))
+        for name in ("data", "list", "scan"):
+            os.mkdir(os.path.join(tmp, name))
+        server = BenchServer(os.path.join(tmp, "data"), pipeline_depth=args.depth)
+        try:
+            results.update(bench_transfer(server, args.mb))
+            results.update(bench_concurrent(server, args.clients, max(1, args.mb // 2)))
+        finally:
+            server.stop()
+        results.update(bench_list(os.path.join(tmp, "list"), args.files))
+        results.update(bench_scan(os.path.join(tmp, "scan"), args.scan_files, args.scan_kib))
+        Logger.flush()
+    if args.sd_mb:
+        # SDCard driver on the simulated SPI card (modelled RP2040 time).
+        for name, r in bench_sdcard.run(mbytes=args.sd_mb, baudrate=args.sd_baudrate).items():
+            results["sd_%s_KiBps" % name] = r["modelled_kib_s"]
+    return results
+
+
+def compare(results, path):
+    with open(path) as f:
+        old = json.load(f)["results"]
+    print("%-22s %12s %12s %8s" % ("metric", "old", "new", "change"))
+    for key in sorted(results):
+        if key not in old:
+            continue
+        change = (results[key] - old[key]) / old[key] * 100 if old[key] else 0
+        print("%-22s %12.2f %12.2f %+7.1f%%" % (key, old[key], results[key], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mb", type=int, default=4, help="RETR/STOR payload size")
+    parser.add_argument("--files", type=int, default=10000, help="files in the LIST test")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=DEFAULT_PIPELINE_DEPTH,
+                        help="transfer pipeline depth (buffers per transfer)")
+    parser.add_argument("--scan-files", type=int, default=32)
+    parser.add_argument("--scan-kib", type=int, default=64)
+    parser.add_argument("--sd-mb", type=int, default=1, help="SD driver test size, 0 skips it")
+    parser.add_argument("--sd-baudrate", type=int, default=bench_sdcard.BENCH_BAUDRATE)
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare with results saved earlier")
+    args = parser.parse_args()
+
+    results = run(args)
+    for key in sorted(results):
+        print("%-22s %12.2f" % (key, results[key]))
+    if args.compare:
+        print()
+        compare(results, args.compare)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({
+                "meta": {
+                    "python": sys.version.split()[0],
+                    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "args": vars(args),
+                },
+                "results": results,
+            }, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Raw SDCard throughput against the fake SPI card.
+
+    python bench/bench_sdcard.py [--driver path/to/sdcard.py] [--mb 1]
+
+Besides host wall time it reports the modelled device time: bytes clocked at
+the SPI baudrate, a fixed cost per SPI call (the interpreter overhead of one
+machine.SPI call on an RP2040) and any time.sleep_ms the driver asked for.
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import host
+
+host.install()
+from fakesd import FakeSDCard, FakePin
+
+SPI_CALL_US = 15
+BENCH_BAUDRATE = 1320000
+
+
+def load_driver(path):
+    if path is None:
+        import sdcard
+        return sdcard
+    spec = importlib.util.spec_from_file_location("sdcard_under_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(card, fn):
+    card.reset_stats()
+    slept = host.clock.slept_ms
+    start = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - start
+    modelled_us = card.bus_us + card.calls * SPI_CALL_US + (host.clock.slept_ms - slept) * 1000
+    return {
+        "wall_s": wall,
+        "spi_calls": card.calls,
+        "clocked": card.clocked,
+        "slept_ms": host.clock.slept_ms - slept,
+        "modelled_s": modelled_us / 1e6,
+    }
+
+
+def run(driver_path=None, mbytes=1, chunk_blocks=8, baudrate=BENCH_BAUDRATE, quiet=True):
+    sdcard = load_driver(driver_path)
+    card = FakeSDCard(blocks=max(8192, mbytes * 2048 * 2))
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        sd = sdcard.SDCard(card, FakePin(), baudrate=baudrate)
+    finally:
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+    nbytes = mbytes * 1024 * 1024
+    chunk = bytearray(os.urandom(chunk_blocks * 512))
+    count = nbytes // len(chunk)
+    results = {}
+
+    def write_multi():
+        for i in range(count):
+            sd.writeblocks(i * chunk_blocks, chunk)
+
+    def read_multi():
+        for i in range(count):
+            sd.readblocks(i * chunk_blocks, chunk)
+
+    single = bytearray(512)
+
+    def read_single():
+        for i in range(nbytes // 512 // 8):
+            sd.readblocks(i, single)
+
+    def write_single():
+        for i in range(nbytes // 512 // 8):
+            sd.writeblocks(i, single)
+
+    for name, fn, size in (("write_multi", write_multi, nbytes),
+                           ("read_multi", read_multi, nbytes),
+                           ("read_single", read_single, nbytes // 8),
+                           ("write_single", write_single, nbytes // 8)):
+        r = measure(card, fn)
+        r["bytes"] = size
+        r["modelled_kib_s"] = size / 1024 / r["modelled_s"] if r["modelled_s"] else 0
+        results[name] = r
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--driver", help="sdcard.py to benchmark (default: repo copy)")
+    parser.add_argument("--mb", type=int, default=1)
+    parser.add_argument("--baudrate", type=int, default=BENCH_BAUDRATE)
+    args = parser.parse_args()
+    results = run(args.driver, args.mb, baudrate=args.baudrate)
+    print("%-13s %10s %10s %10s %10s %12s" % ("test", "wall_s", "spi_calls", "slept_ms", "model_s", "model_KiB/s"))
+    for name, r in results.items():
+        print("%-13s %10.3f %10d %10d %10.3f %12.1f" % (
+            name, r["wall_s"], r["spi_calls"], r["slept_ms"], r["modelled_s"], r["modelled_kib_s"]))
+
+
+if __name__ == "__main__":
+    main()
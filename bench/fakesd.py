@@ -0,0 +1,258 @@
+"""
+RAM-backed SD card that answers the SPI-mode protocol spoken by
+sdcard.SDCard, plus the Pin stand-in for its chip select.
+"""
+
+_BLOCK = 512
+
+
+def crc16(data):
+    crc = 0
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        crc &= 0xFFFF
+    return crc
+
+
+def crc7(data):
+    crc = 0
+    for d in data:
+        for _ in range(8):
+            crc <<= 1
+            if (d ^ crc) & 0x80:
+                crc ^= 0x09
+            d <<= 1
+        crc &= 0x7F
+    return crc
+
+
+class FakePin:
+    OUT = 1
+    IN = 0
+
+    def __init__(self, *args, **kwargs):
+        self.value_ = 1
+
+    def init(self, mode=None, value=None, **kwargs):
+        if value is not None:
+            self.value_ = value
+
+    def value(self, v=None):
+        if v is None:
+            return self.value_
+        self.value_ = v
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+
+class FakeSDCard:
+    # Acts as the SPI bus object handed to SDCard. MISO bytes come from an
+    # output queue; MOSI bytes are parsed as commands or write payloads.
+    # token_delay is how many 0xFF bytes precede each read data token and
+    # busy_bytes how long the card stays busy after a write, both in bytes
+    # clocked, i.e. they model card latency in bus time. Above max_baudrate
+    # the link corrupts one byte of every data block in either direction.
+    def __init__(self, blocks=8192, token_delay=16, busy_bytes=64, sdhc=True,
+                 max_baudrate=None):
+        self.image = bytearray(blocks * _BLOCK)
+        self.blocks = blocks
+        self.token_delay = token_delay
+        self.busy_bytes = busy_bytes
+        self.sdhc = sdhc
+        self.max_baudrate = max_baudrate
+        self.baudrate = 0
+        self.out = bytearray()
+        self.pos = 0
+        self.cmd = bytearray()
+        self.mode = None
+        self.next_block = 0
+        self.write_block = 0
+        self.payload = None
+        self.crc_enabled = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.corrupted = 0
+        self.calls = 0
+        self.clocked = 0
+        self.bus_us = 0.0
+
+    # --- machine.SPI interface -------------------------------------------
+
+    def init(self, *args, **kwargs):
+        self.baudrate = kwargs.get("baudrate", self.baudrate)
+
+    def write(self, buf):
+        self._account(len(buf))
+        self._drop_out(len(buf))
+        self._feed(buf)
+
+    def readinto(self, buf, write=0xFF):
+        self._account(len(buf))
+        self._fill(buf)
+        if write != 0xFF:
+            self._feed(bytes([write]) * len(buf))
+
+    def read(self, nbytes, write=0xFF):
+        buf = bytearray(nbytes)
+        self.readinto(buf, write)
+        return bytes(buf)
+
+    def write_readinto(self, wbuf, rbuf):
+        self._account(len(rbuf))
+        self._fill(rbuf)
+        self._feed(wbuf)
+
+    # --- internals -------------------------------------------------------
+
+    def _account(self, n):
+        self.calls += 1
+        self.clocked += n
+        if self.baudrate:
+            self.bus_us += n * 8 * 1e6 / self.baudrate
+
+    def _queue(self, data):
+        if self.pos > 4096:
+            del self.out[:self.pos]
+            self.pos = 0
+        self.out += data
+
+    def _drop_out(self, n):
+        self.pos = min(self.pos + n, len(self.out))
+
+    def _fill(self, buf):
+        n = len(buf)
+        i = 0
+        while i < n:
+            avail = len(self.out) - self.pos
+            if not avail:
+                if self.mode == "r18":
+                    self._queue_block(self.next_block)
+                    self.next_block += 1
+                    continue
+                buf[i:] = b"\xff" * (n - i)
+                return
+            take = min(avail, n - i)
+            buf[i:i + take] = self.out[self.pos:self.pos + take]
+            self.pos += take
+            i += take
+
+    def _noisy(self):
+        return self.max_baudrate is not None and self.baudrate > self.max_baudrate
+
+    def _queue_block(self, block):
+        start = block * _BLOCK
+        data = bytearray(self.image[start:start + _BLOCK])
+        crc = crc16(data) if self.crc_enabled else 0
+        if self._noisy():
+            data[block % _BLOCK] ^= 0x10
+            self.corrupted += 1
+        self._queue(b"\xff" * self.token_delay + b"\xfe")
+        self._queue(data)
+        self._queue(crc.to_bytes(2, "big"))
+
+    def _feed(self, data):
+        data = bytes(data)
+        i = 0
+        n = len(data)
+        while i < n:
+            if self.payload is not None:
+                take = min(_BLOCK + 2 - len(self.payload), n - i)
+                self.payload += data[i:i + take]
+                i += take
+                if len(self.payload) == _BLOCK + 2:
+                    self._store_payload()
+                continue
+            b = data[i]
+            i += 1
+            if self.mode in ("w24", "w25") and not self.cmd:
+                if (b == 0xFE and self.mode == "w24") or (b == 0xFC and self.mode == "w25"):
+                    self.payload = bytearray()
+                    continue
+                if b == 0xFD and self.mode == "w25":
+                    self.mode = None
+                    self._queue(b"\xff" + b"\x00" * self.busy_bytes + b"\xff")
+                    continue
+            if self.cmd or (b & 0xC0) == 0x40:
+                self.cmd.append(b)
+                if len(self.cmd) == 6:
+                    cmd = bytes(self.cmd)
+                    self.cmd = bytearray()
+                    if self.crc_enabled and (crc7(cmd[:5]) << 1 | 1) != cmd[5]:
+                        self._queue(b"\xff\x08")
+                        continue
+                    self._command(cmd[0] & 0x3F, int.from_bytes(cmd[1:5], "big"))
+
+    def _store_payload(self):
+        data = self.payload[:_BLOCK]
+        crc = int.from_bytes(self.payload[_BLOCK:], "big")
+        self.payload = None
+        if self._noisy():
+            data[0] ^= 0x01
+            self.corrupted += 1
+        if self.crc_enabled and crc16(data) != crc:
+            self._queue(b"\x0b\xff")
+            if self.mode == "w24":
+                self.mode = None
+            return
+        start = self.write_block * _BLOCK
+        self.image[start:start + _BLOCK] = data
+        self.write_block += 1
+        self._queue(b"\x05" + b"\x00" * self.busy_bytes + b"\xff")
+        if self.mode == "w24":
+            self.mode = None
+
+    def _command(self, cmd, arg):
+        block = arg if self.sdhc else arg // _BLOCK
+        r1 = b"\xff\x00"
+        if cmd == 0:
+            self.out = bytearray()
+            self.pos = 0
+            self.mode = None
+            self._queue(b"\xff\x01")
+        elif cmd == 8:
+            self._queue(b"\xff\x01\x00\x00\x01\xaa")
+        elif cmd == 55:
+            self._queue(r1)
+        elif cmd == 41:
+            self._queue(r1)
+        elif cmd == 58:
+            self._queue(r1 + (b"\xc0" if self.sdhc else b"\x80") + b"\xff\x80\x00")
+        elif cmd == 59:
+            self.crc_enabled = bool(arg & 1)
+            self._queue(r1)
+        elif cmd == 9:
+            csd = bytearray(16)
+            csd[0] = 0x40
+            c_size = self.blocks // 1024 - 1
+            csd[8] = (c_size >> 8) & 0xFF
+            csd[9] = c_size & 0xFF
+            crc = crc16(csd) if self.crc_enabled else 0
+            self._queue(r1 + b"\xff" * self.token_delay + b"\xfe" + csd + crc.to_bytes(2, "big"))
+        elif cmd == 16:
+            self._queue(r1)
+        elif cmd == 17:
+            self._queue(r1)
+            self._queue_block(block)
+        elif cmd == 18:
+            self._queue(r1)
+            self.mode = "r18"
+            self.next_block = block
+        elif cmd == 12:
+            self.out = bytearray()
+            self.pos = 0
+            self.mode = None
+            self._queue(b"\xff\x00")
+        elif cmd == 24:
+            self._queue(r1)
+            self.mode = "w24"
+            self.write_block = block
+        elif cmd == 25:
+            self._queue(r1)
+            self.mode = "w25"
+            self.write_block = block
+        else:
+            self._queue(b"\xff\x04")
@@ -0,0 +1,38 @@
+"""
+Host (CPython) environment for the benchmarks: puts the repo and the
+stand-in MicroPython modules on sys.path and adds the MicroPython-only
+time functions the firmware uses.
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS = os.path.join(ROOT, "bench", "stubs")
+
+
+class SimClock:
+    # time.sleep_ms does not really sleep on the host; it advances this clock
+    # so sleeps show up in the modelled time instead of stretching runs.
+    def __init__(self):
+        self.slept_ms = 0
+
+    def sleep_ms(self, ms):
+        self.slept_ms += ms
+
+
+clock = SimClock()
+
+
+def install():
+    for path in (ROOT, STUBS):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    time.sleep_ms = clock.sleep_ms
+    if not hasattr(time, "sleep_us"):
+        time.sleep_us = lambda us: None
+    if not hasattr(time, "ticks_ms"):
+        time.ticks_ms = lambda: int(time.monotonic() * 1000)
+        time.ticks_us = lambda: int(time.monotonic() * 1000000)
+        time.ticks_diff = lambda end, start: end - start
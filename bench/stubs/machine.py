@@ -0,0 +1,43 @@
+# Host stand-in for MicroPython's machine module. SPI(...) hands out the
+# simulated card set in SPI.device (a fakesd.FakeSDCard by default), so
+# sdcard.SDCard and main.mount_sdcard can be driven without hardware.
+
+
+class Pin:
+    OUT = 1
+    IN = 0
+    PULL_UP = 1
+
+    def __init__(self, id=None, mode=None, value=None, **kwargs):
+        self.id = id
+        self.value_ = 1 if value is None else value
+
+    def init(self, mode=None, value=None, **kwargs):
+        if value is not None:
+            self.value_ = value
+
+    def value(self, v=None):
+        if v is None:
+            return self.value_
+        self.value_ = v
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+
+class SPI:
+    device = None
+
+    def __new__(cls, id=0, *args, **kwargs):
+        if SPI.device is None:
+            from fakesd import FakeSDCard
+            SPI.device = FakeSDCard()
+        return SPI.device
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+def freq(hz=None):
+    return 125000000
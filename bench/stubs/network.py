@@ -0,0 +1,40 @@
+# Host stand-in for MicroPython's network module: a station interface that
+# is always connected on loopback.
+
+STA_IF = 0
+AP_IF = 1
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+IP = "127.0.0.1"
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._connected = False
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = bool(state)
+
+    def connect(self, ssid=None, password=None):
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected or self._active
+
+    def status(self):
+        return STAT_GOT_IP if self.isconnected() else STAT_IDLE
+
+    def ifconfig(self):
+        return (IP, "255.255.255.0", IP, IP)
@@ -0,0 +1,202 @@
+"""
+Write-back LRU block cache for a MicroPython block device (e.g. SDCard).
+"""
+
+import struct
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ucollections import OrderedDict
+
+_BLOCK_SIZE = 512
+_IOCTL_DEINIT = 2
+_IOCTL_SYNC = 3
+
+
+class BlockCache:
+    # Single-block reads and writes are served from a fixed slab of
+    # cache_bytes // 512 slots. FAT and root directory sectors are pinned (up
+    # to a quarter of the slots) so directory walks keep hitting them; other
+    # blocks are evicted least recently used first. Dirty blocks are written
+    # back on sync, on eviction or when too many pile up, with adjacent
+    # blocks merged into one multi-block (CMD25) write.
+    MAX_RUN_BLOCKS = 8
+
+    def __init__(self, dev, cache_bytes=16 * 1024):
+        self.dev = dev
+        self.nslots = max(cache_bytes // _BLOCK_SIZE, 2)
+        self.slab = bytearray(self.nslots * _BLOCK_SIZE)
+        self.slab_mv = memoryview(self.slab)
+        self.free = list(range(self.nslots))
+        self.lru = OrderedDict()
+        self.pinned = {}
+        self.max_pinned = self.nslots // 4
+        self.max_dirty = self.nslots // 2
+        self.dirty = set()
+        self.run_buf = bytearray(BlockCache.MAX_RUN_BLOCKS * _BLOCK_SIZE)
+        self.meta = ()
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+        self.coalesced = 0
+        self._probe_layout()
+
+    def _probe_layout(self):
+        # Locate the FAT and root directory of the first FAT volume; any
+        # unexpected layout just leaves nothing pinned.
+        buf = bytearray(_BLOCK_SIZE)
+        try:
+            self.dev.readblocks(0, buf)
+            base = 0
+            if buf[0] not in (0xEB, 0xE9):
+                base = struct.unpack_from("<I", buf, 446 + 8)[0]
+                self.dev.readblocks(base, buf)
+            if buf[510] != 0x55 or buf[511] != 0xAA:
+                return
+            bytes_per_sec, sec_per_clus, reserved, nfats, root_entries = \
+                struct.unpack_from("<HBHBH", buf, 11)
+            if bytes_per_sec != _BLOCK_SIZE:
+                return
+            fat_size = struct.unpack_from("<H", buf, 22)[0]
+            fat_start = base + reserved
+            data_start = fat_start + nfats * (fat_size or struct.unpack_from("<I", buf, 36)[0])
+            if fat_size:
+                root_secs = (root_entries * 32 + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+                self.meta = ((fat_start, fat_start + fat_size),
+                             (data_start, data_start + root_secs))
+            else:
+                fat_size = struct.unpack_from("<I", buf, 36)[0]
+                root_cluster = struct.unpack_from("<I", buf, 44)[0]
+                root_start = data_start + (root_cluster - 2) * sec_per_clus
+                self.meta = ((fat_start, fat_start + fat_size),
+                             (root_start, root_start + sec_per_clus))
+        except Exception:
+            self.meta = ()
+
+    def _is_meta(self, block_num):
+        for start, end in self.meta:
+            if start <= block_num < end:
+                return True
+        return False
+
+    def _lookup(self, block_num):
+        slot = self.pinned.get(block_num)
+        if slot is not None:
+            return slot
+        slot = self.lru.pop(block_num, None)
+        if slot is not None:
+            self.lru[block_num] = slot
+        return slot
+
+    def _peek(self, block_num):
+        slot = self.pinned.get(block_num)
+        return slot if slot is not None else self.lru.get(block_num)
+
+    def _allocate(self, block_num):
+        if not self.free:
+            self._evict()
+        slot = self.free.pop()
+        if len(self.pinned) < self.max_pinned and self._is_meta(block_num):
+            self.pinned[block_num] = slot
+        else:
+            self.lru[block_num] = slot
+        return slot
+
+    def _evict(self):
+        for block_num in self.lru:
+            if block_num not in self.dirty:
+                break
+        else:
+            self.flush()
+            block_num = next(iter(self.lru))
+        self.free.append(self.lru.pop(block_num))
+
+    def _slot(self, slot):
+        return self.slab_mv[slot * _BLOCK_SIZE:(slot + 1) * _BLOCK_SIZE]
+
+    def readblocks(self, block_num, buf):
+        nblocks = len(buf) // _BLOCK_SIZE
+        if nblocks != 1:
+            for b in self.dirty:
+                if block_num <= b < block_num + nblocks:
+                    self.flush()
+                    break
+            self.dev.readblocks(block_num, buf)
+            return
+        slot = self._lookup(block_num)
+        if slot is not None:
+            self.hits += 1
+            buf[:] = self._slot(slot)
+            return
+        self.misses += 1
+        slot = self._allocate(block_num)
+        data = self._slot(slot)
+        try:
+            self.dev.readblocks(block_num, data)
+        except Exception:
+            self._drop(block_num)
+            raise
+        buf[:] = data
+
+    def writeblocks(self, block_num, buf):
+        nblocks = len(buf) // _BLOCK_SIZE
+        if nblocks != 1:
+            # Large writes go straight through; cached copies are refreshed.
+            self.dev.writeblocks(block_num, buf)
+            mv = memoryview(buf)
+            for i in range(nblocks):
+                slot = self._lookup(block_num + i)
+                if slot is not None:
+                    self._slot(slot)[:] = mv[i * _BLOCK_SIZE:(i + 1) * _BLOCK_SIZE]
+                    self.dirty.discard(block_num + i)
+            return
+        slot = self._lookup(block_num)
+        if slot is None:
+            slot = self._allocate(block_num)
+        self._slot(slot)[:] = buf
+        self.dirty.add(block_num)
+        if len(self.dirty) > self.max_dirty:
+            self.flush()
+
+    def _drop(self, block_num):
+        slot = self.pinned.pop(block_num, None)
+        if slot is None:
+            slot = self.lru.pop(block_num, None)
+        if slot is not None:
+            self.free.append(slot)
+        self.dirty.discard(block_num)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        blocks = sorted(self.dirty)
+        run_mv = memoryview(self.run_buf)
+        i = 0
+        while i < len(blocks):
+            start = blocks[i]
+            n = 0
+            while (i < len(blocks) and blocks[i] == start + n
+                   and n < BlockCache.MAX_RUN_BLOCKS):
+                run_mv[n * _BLOCK_SIZE:(n + 1) * _BLOCK_SIZE] = self._slot(self._peek(blocks[i]))
+                n += 1
+                i += 1
+            self.dev.writeblocks(start, run_mv[:n * _BLOCK_SIZE])
+            self.writebacks += 1
+            if n > 1:
+                self.coalesced += n
+        self.dirty.clear()
+
+    def ioctl(self, op, arg):
+        if op == _IOCTL_SYNC or op == _IOCTL_DEINIT:
+            self.flush()
+        return self.dev.ioctl(op, arg)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writebacks": self.writebacks,
+            "coalesced": self.coalesced,
+            "dirty": len(self.dirty),
+            "pinned": len(self.pinned),
+        }
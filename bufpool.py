@@ -0,0 +1,58 @@
+"""
+Preallocated transfer buffers shared by all FTP sessions, and heap checks for admitting new work.
+"""
+
+import gc
+from transfer import Pipeline
+
+# Heap that must stay free (after a collection) to accept a new control
+# connection or start a data transfer.
+SESSION_RESERVE = 12 * 1024
+TRANSFER_RESERVE = 8 * 1024
+
+
+def mem_available(reserve):
+    # Collects only when the cheap check fails. Without gc.mem_free (CPython)
+    # there is no budget to enforce.
+    mem_free = getattr(gc, "mem_free", None)
+    if mem_free is None:
+        return True
+    if mem_free() >= reserve:
+        return True
+    gc.collect()
+    return mem_free() >= reserve
+
+
+class BufferPool:
+    # All transfer pipelines are allocated once, at start-up, while the heap
+    # is still in one piece. A transfer or digest checks one out and hands it
+    # back when done, so no block-sized buffer is allocated per transfer;
+    # when none is free the caller refuses the work instead.
+    def __init__(self, slots, depth, size):
+        if slots < 1:
+            raise ValueError("pool needs at least one slot")
+        self.slots = slots
+        self.free = [Pipeline(depth, size) for _ in range(slots)]
+        self.refused = 0
+        self.peak = 0
+
+    def acquire(self, reserve=TRANSFER_RESERVE):
+        if not self.free or not mem_available(reserve):
+            self.refused += 1
+            return None
+        pipe = self.free.pop()
+        in_use = self.slots - len(self.free)
+        if in_use > self.peak:
+            self.peak = in_use
+        return pipe
+
+    def release(self, pipe):
+        self.free.append(pipe)
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "free": len(self.free),
+            "peak": self.peak,
+            "refused": self.refused,
+        }
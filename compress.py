@@ -0,0 +1,188 @@
+"""
+MODE Z (deflate) stream adapters for the FTP data channel.
+"""
+
+import io
+from transfer import recv_into
+
+try:
+    import deflate
+    zlib = None
+except ImportError:
+    deflate = None
+    try:
+        import zlib
+    except ImportError:
+        zlib = None
+
+AVAILABLE = deflate is not None or zlib is not None
+
+DEFAULT_LEVEL = 6
+# 2^10 = 1 KiB compression window. The inflate window is whatever the sender
+# declares in the zlib header (at most 32 KiB), so it is only allocated while
+# a compressed upload is running.
+COMPRESS_WBITS = 10
+ZLIB_MEM_LEVEL = 4
+# MicroPython's inflater pulls its input, so it is only run while at least
+# this much compressed data is buffered (or the stream has ended).
+INFLATE_LOOKAHEAD = 1024
+INFLATE_IN_SIZE = 1024
+
+COMPRESSED_EXTENSIONS = (
+    ".gz", ".tgz", ".zip", ".bz2", ".xz", ".7z", ".z", ".zst", ".lz4",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv",
+    ".ogg", ".avi", ".mov", ".pdf",
+)
+
+
+def is_compressed_name(name):
+    name = name.lower()
+    for ext in COMPRESSED_EXTENSIONS:
+        if name.endswith(ext):
+            return True
+    return False
+
+
+class _Collect(io.IOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, buf):
+        self.chunks.append(bytes(buf))
+        return len(buf)
+
+    def take(self):
+        out = b"".join(self.chunks)
+        self.chunks = []
+        return out
+
+
+class _Feed(io.IOBase):
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+        self.size = 0
+        self.final = False
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def readinto(self, buf):
+        if not self.chunks:
+            if self.final:
+                return 0
+            raise OSError("compressed stream underrun")
+        chunk = self.chunks[0]
+        n = min(len(buf), len(chunk) - self.pos)
+        buf[:n] = chunk[self.pos:self.pos + n]
+        self.pos += n
+        self.size -= n
+        if self.pos == len(chunk):
+            self.chunks.pop(0)
+            self.pos = 0
+        return n
+
+
+class Deflater:
+    # Level 0 means stored blocks where zlib is available. MicroPython's
+    # compressor has no levels; there level 0 only drops to its smallest
+    # (256 B) window, which is also its cheapest.
+    def __init__(self, level=DEFAULT_LEVEL, wbits=COMPRESS_WBITS):
+        if deflate is not None:
+            self.out = _Collect()
+            self.stream = deflate.DeflateIO(
+                self.out, deflate.ZLIB, wbits if level else 8)
+            self.obj = None
+        else:
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, wbits, ZLIB_MEM_LEVEL)
+
+    def compress(self, data):
+        if self.obj is not None:
+            return self.obj.compress(data)
+        self.stream.write(data)
+        return self.out.take()
+
+    def flush(self):
+        if self.obj is not None:
+            return self.obj.flush()
+        self.stream.close()
+        return self.out.take()
+
+
+class Inflater:
+    def __init__(self):
+        if deflate is not None:
+            self.src = _Feed()
+            self.stream = deflate.DeflateIO(self.src, deflate.ZLIB)
+            self.obj = None
+        else:
+            self.obj = zlib.decompressobj()
+            self.tail = b""
+
+    def feed(self, data):
+        if self.obj is not None:
+            self.tail = self.tail + data if self.tail else data
+        else:
+            self.src.append(data)
+
+    def readinto(self, mv, final):
+        # Returns the number of bytes inflated into mv; 0 means more input is
+        # needed, or with final set, that the stream is complete.
+        if self.obj is not None:
+            out = self.obj.decompress(self.tail, len(mv))
+            self.tail = self.obj.unconsumed_tail
+            if not out and final and not self.obj.eof:
+                raise OSError("truncated compressed stream")
+            mv[:len(out)] = out
+            return len(out)
+        if not final and self.src.size < INFLATE_LOOKAHEAD:
+            return 0
+        self.src.final = final
+        return self.stream.readinto(mv) or 0
+
+
+class DeflateWriter:
+    # Stands in for the data connection writer in send_file.
+    def __init__(self, writer, level=DEFAULT_LEVEL):
+        self.writer = writer
+        self.deflater = Deflater(level)
+        self.sent = 0
+
+    def write(self, data):
+        out = self.deflater.compress(data)
+        if out:
+            self.writer.write(out)
+            self.sent += len(out)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def finish(self):
+        out = self.deflater.flush()
+        self.writer.write(out)
+        self.sent += len(out)
+        await self.writer.drain()
+
+
+class InflateReader:
+    # Stands in for the data connection reader in recv_file.
+    def __init__(self, reader):
+        self.reader = reader
+        self.inflater = Inflater()
+        self.buf = bytearray(INFLATE_IN_SIZE)
+        self.mv = memoryview(self.buf)
+        self.received = 0
+        self.eof = False
+
+    async def readinto(self, mv):
+        while True:
+            n = self.inflater.readinto(mv, self.eof)
+            if n or self.eof:
+                return n
+            got = await recv_into(self.reader, self.mv)
+            if not got:
+                self.eof = True
+            else:
+                self.received += got
+                self.inflater.feed(bytes(self.mv[:got]))
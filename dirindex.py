@@ -0,0 +1,125 @@
+"""
+Resident index of the served directory: name -> size, mtime, type.
+"""
+
+import os
+from utils import ticks_ms, ticks_diff
+
+_S_IFDIR = 0x4000
+
+
+class DirIndex:
+    # Built lazily on first use from one directory walk; mtimes are only
+    # stat'ed when asked for. The server updates entries itself after STOR
+    # and DELE. Changes made behind its back are caught by a change in the
+    # volume's free block count (checked on every lookup while no upload is
+    # in flight) or, failing that, by REFRESH_MS expiring.
+    REFRESH_MS = 30000
+
+    def __init__(self, root="/sd", hidden=None):
+        self.root = root
+        self.hidden = hidden
+        self.entries = None
+        self.scanned_at = 0
+        self.free = None
+        self.writers = 0
+        self.scans = 0
+
+    def _path(self, name):
+        return self.root + "/" + name
+
+    def _free_blocks(self):
+        try:
+            return os.statvfs(self.root)[3]
+        except (OSError, AttributeError):
+            return None
+
+    def _scan(self):
+        entries = {}
+        ilistdir = getattr(os, "ilistdir", None)
+        if ilistdir is not None:
+            for item in ilistdir(self.root):
+                name = item[0]
+                if self.hidden is not None and self.hidden(name):
+                    continue
+                is_dir = item[1] == _S_IFDIR
+                size = item[3] if len(item) > 3 and not is_dir else None
+                entries[name] = [size, None, is_dir]
+        else:
+            for name in os.listdir(self.root):
+                if self.hidden is not None and self.hidden(name):
+                    continue
+                entries[name] = self._stat_entry(name)
+        self.entries = entries
+        self.scanned_at = ticks_ms()
+        self.free = self._free_blocks()
+        self.scans += 1
+
+    def _stat_entry(self, name):
+        st = os.stat(self._path(name))
+        is_dir = st[0] & _S_IFDIR == _S_IFDIR
+        return [0 if is_dir else st[6], st[8], is_dir]
+
+    def _stale(self):
+        if self.entries is None:
+            return True
+        if ticks_diff(ticks_ms(), self.scanned_at) >= DirIndex.REFRESH_MS:
+            return True
+        return not self.writers and self._free_blocks() != self.free
+
+    def refresh(self):
+        if self._stale():
+            self._scan()
+        return self.entries
+
+    def invalidate(self):
+        self.entries = None
+
+    def names(self):
+        return list(self.refresh())
+
+    def get(self, name):
+        entry = self.refresh().get(name)
+        if entry is not None and entry[0] is None:
+            entry[:] = self._stat_entry(name)
+        return entry
+
+    def exists(self, name):
+        entry = self.get(name)
+        return entry is not None and not entry[2]
+
+    def size(self, name):
+        entry = self.get(name)
+        return entry[0] if entry is not None else None
+
+    def mtime(self, name):
+        entry = self.get(name)
+        if entry is None:
+            return None
+        if entry[1] is None:
+            entry[:] = self._stat_entry(name)
+        return entry[1]
+
+    def begin_write(self):
+        self.writers += 1
+
+    def end_write(self, name):
+        self.writers -= 1
+        self.update(name)
+
+    def update(self, name):
+        if self.entries is None:
+            return
+        try:
+            self.entries[name] = self._stat_entry(name)
+        except OSError:
+            self.entries.pop(name, None)
+        if not self.writers:
+            self.free = self._free_blocks()
+
+    def remove(self, name):
+        if self.entries is None:
+            return
+        self.entries.pop(name, None)
+        if not self.writers:
+            self.free = self._free_blocks()
@@ -0,0 +1,286 @@
+"""
+FAT16/FAT32 lookups that map written card sectors back to the files they belong to.
+"""
+
+import struct
+
+_BLOCK_SIZE = 512
+_ATTR_LFN = 0x0F
+_ATTR_VOLUME = 0x08
+_ATTR_DIR = 0x10
+_DELETED = 0xE5
+# Offsets of the UTF-16 name characters in a long file name entry.
+_LFN_CHARS = (1, 3, 5, 7, 9, 14, 16, 18, 20, 22, 24, 28, 30)
+
+
+class FatVolume:
+    # The first FAT volume on a block device, located the same way as in
+    # BlockCache. Reads go through the device the filesystem is mounted on,
+    # so sectors still held dirty in a BlockCache are seen as written.
+    # FAT12 and exFAT volumes are rejected with ValueError.
+    def __init__(self, dev):
+        self.dev = dev
+        self.buf = bytearray(_BLOCK_SIZE)
+        self.fat_buf = bytearray(_BLOCK_SIZE)
+        self.fat_sector = -1
+        buf = self.buf
+        dev.readblocks(0, buf)
+        base = 0
+        if buf[0] not in (0xEB, 0xE9):
+            base = struct.unpack_from("<I", buf, 446 + 8)[0]
+            dev.readblocks(base, buf)
+        if buf[510] != 0x55 or buf[511] != 0xAA:
+            raise ValueError("no FAT boot sector")
+        bytes_per_sec, sec_per_clus, reserved, nfats, root_entries, total16 = \
+            struct.unpack_from("<HBHBHH", buf, 11)
+        if bytes_per_sec != _BLOCK_SIZE or not sec_per_clus:
+            raise ValueError("unsupported sector size")
+        fat_size = struct.unpack_from("<H", buf, 22)[0] or struct.unpack_from("<I", buf, 36)[0]
+        total = total16 or struct.unpack_from("<I", buf, 32)[0]
+        root_secs = (root_entries * 32 + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+        self.sec_per_clus = sec_per_clus
+        self.fat_start = base + reserved
+        self.fat_end = self.fat_start + nfats * fat_size
+        self.root_start = self.fat_end
+        self.data_start = self.root_start + root_secs
+        self.clusters = (total - (self.data_start - base)) // sec_per_clus
+        if self.clusters < 4085:
+            raise ValueError("FAT12 is not supported")
+        self.fat32 = self.clusters >= 65525
+        if self.fat32:
+            self.root_cluster = struct.unpack_from("<I", buf, 44)[0]
+            self.eoc = 0x0FFFFFF8
+        else:
+            self.root_cluster = 0
+            self.eoc = 0xFFF8
+
+    def meta_ranges(self):
+        # Sector ranges [start, end) of the FATs and the FAT16 root directory.
+        ranges = [(self.fat_start, self.fat_end)]
+        if self.data_start > self.root_start:
+            ranges.append((self.root_start, self.data_start))
+        return ranges
+
+    def cluster_sector(self, cluster):
+        return self.data_start + (cluster - 2) * self.sec_per_clus
+
+    def next_cluster(self, cluster):
+        offset = cluster * 4 if self.fat32 else cluster * 2
+        sector = self.fat_start + offset // _BLOCK_SIZE
+        if sector != self.fat_sector:
+            self.dev.readblocks(sector, self.fat_buf)
+            self.fat_sector = sector
+        offset %= _BLOCK_SIZE
+        if self.fat32:
+            return struct.unpack_from("<I", self.fat_buf, offset)[0] & 0x0FFFFFFF
+        return struct.unpack_from("<H", self.fat_buf, offset)[0]
+
+    def chain(self, cluster):
+        # Sector extents [(start, end, byte offset in the file)] of a cluster
+        # chain, contiguous clusters merged. A chain running off the volume
+        # or longer than the volume (a loop) raises ValueError.
+        extents = []
+        if cluster < 2:
+            return extents
+        clus_bytes = self.sec_per_clus * _BLOCK_SIZE
+        offset = 0
+        # The FAT may have changed since the last walk.
+        self.fat_sector = -1
+        for _ in range(self.clusters):
+            if not 2 <= cluster < self.clusters + 2:
+                raise ValueError("bad cluster %d" % cluster)
+            start = self.cluster_sector(cluster)
+            if extents and extents[-1][1] == start:
+                extents[-1] = (extents[-1][0], start + self.sec_per_clus, extents[-1][2])
+            else:
+                extents.append((start, start + self.sec_per_clus, offset))
+            offset += clus_bytes
+            cluster = self.next_cluster(cluster)
+            if cluster >= self.eoc:
+                return extents
+        raise ValueError("cluster chain loops")
+
+    def _dir_extents(self, cluster):
+        if cluster == 0:
+            if self.fat32:
+                cluster = self.root_cluster
+            else:
+                return [(self.root_start, self.data_start, 0)]
+        return self.chain(cluster)
+
+    def _find(self, extents, name):
+        # (cluster, size, attr, modification stamp) of name in a directory.
+        name = name.lower()
+        buf = self.buf
+        lfn = []
+        for start, end, _ in extents:
+            for sector in range(start, end):
+                self.dev.readblocks(sector, buf)
+                for pos in range(0, _BLOCK_SIZE, 32):
+                    first = buf[pos]
+                    if first == 0:
+                        return None
+                    attr = buf[pos + 11]
+                    if first == _DELETED:
+                        lfn = []
+                        continue
+                    if attr == _ATTR_LFN:
+                        if first & 0x40:
+                            lfn = []
+                        lfn.append(_lfn_part(buf, pos))
+                        continue
+                    long_name = "".join(reversed(lfn)).lower() if lfn else None
+                    lfn = []
+                    if attr & _ATTR_VOLUME:
+                        continue
+                    if long_name != name and _short_name(buf, pos) != name:
+                        continue
+                    hi, stamp, lo, size = struct.unpack_from("<HIHI", buf, pos + 20)
+                    cluster = lo | (hi << 16 if self.fat32 else 0)
+                    return cluster, size, attr, stamp
+        return None
+
+    def lookup(self, path):
+        # (cluster, size, stamp, dir extents) of a volume-relative path, the
+        # dir extents being every directory walked to reach it; None if any
+        # component is missing.
+        cluster = 0
+        walked = []
+        parts = [p for p in path.split("/") if p]
+        for i, part in enumerate(parts):
+            extents = self._dir_extents(cluster)
+            walked.extend(extents)
+            entry = self._find(extents, part)
+            if entry is None:
+                return None
+            cluster, size, attr, stamp = entry
+            if i < len(parts) - 1 and not attr & _ATTR_DIR:
+                return None
+        if not parts:
+            return None
+        return cluster, size, stamp, walked
+
+
+def _lfn_part(buf, pos):
+    chars = []
+    for off in _LFN_CHARS:
+        c = buf[pos + off] | buf[pos + off + 1] << 8
+        if c in (0, 0xFFFF):
+            break
+        chars.append(chr(c))
+    return "".join(chars)
+
+
+def _short_name(buf, pos):
+    base = "".join(chr(b) for b in buf[pos:pos + 8]).rstrip(" ")
+    if base[:1] == "\x05":
+        base = "\xe5" + base[1:]
+    ext = "".join(chr(b) for b in buf[pos + 8:pos + 11]).rstrip(" ")
+    return (base + "." + ext if ext else base).lower()
+
+
+def _overlaps(start, end, ranges):
+    for s, e in ranges:
+        if s < end and start < e:
+            return True
+    return False
+
+
+class DirtyResolver:
+    # Turns the sectors an SDCard reports written (take_dirty()) into work
+    # for the tamper scanner. Each monitored file is resolved to its
+    # directory entry and cluster chain. A write to a FAT, or to any
+    # directory walked to reach a monitored file, re-resolves them all, and
+    # files whose entry (first cluster, size, mtime) or chain changed are
+    # reported as changed; a write inside a file's data is reported as the
+    # byte ranges it covers. A new card generation (first poll, remount,
+    # failed I/O) means writes may have been missed and asks for a rescan.
+    # Long cluster chains make every FAT write more expensive, so this
+    # suits small monitored files best.
+    def __init__(self, card, volume, root):
+        self.card = card
+        self.volume = volume
+        self.root = root.rstrip("/") + "/"
+        self.generation = None
+        self.files = {}
+        self.meta = []
+        self.rescans = 0
+        self.resolves = 0
+        self.meta_hits = 0
+        self.data_hits = 0
+
+    def _resolve(self, path):
+        self.resolves += 1
+        if not path.startswith(self.root):
+            return None
+        found = self.volume.lookup(path[len(self.root):])
+        if found is None:
+            return None
+        cluster, size, stamp, walked = found
+        for start, end, _ in walked:
+            if (start, end) not in self.meta:
+                self.meta.append((start, end))
+        try:
+            return cluster, size, stamp, self.volume.chain(cluster)
+        except ValueError:
+            return None
+
+    def _resolve_all(self, paths):
+        self.meta = self.volume.meta_ranges()
+        old = self.files
+        self.files = {}
+        changed = []
+        for path in paths:
+            record = self.files[path] = self._resolve(path)
+            if path in old and old[path] != record:
+                changed.append(path)
+        return changed
+
+    def poll(self, paths):
+        # None when everything must be rescanned, otherwise (changed paths,
+        # {path: [(start, end) byte ranges written]}).
+        dirty = self.card.take_dirty()
+        if self.card.generation != self.generation:
+            self.generation = self.card.generation
+            self.rescans += 1
+            self._resolve_all(paths)
+            return None
+        changed = []
+        ranges = {}
+        if len(self.files) != len(paths) or any(path not in self.files for path in paths):
+            self.files = {path: self.files[path] if path in self.files else self._resolve(path)
+                          for path in paths}
+        if not dirty:
+            return changed, ranges
+        for start, end in dirty:
+            if _overlaps(start, end, self.meta):
+                self.meta_hits += 1
+                changed = self._resolve_all(paths)
+                break
+        for path, record in self.files.items():
+            if record is None or path in changed:
+                continue
+            size = record[1]
+            for start, end, offset in record[3]:
+                for d_start, d_end in dirty:
+                    lo = max(start, d_start)
+                    hi = min(end, d_end)
+                    if lo >= hi:
+                        continue
+                    first = offset + (lo - start) * _BLOCK_SIZE
+                    last = min(offset + (hi - start) * _BLOCK_SIZE, size)
+                    if first < last:
+                        ranges.setdefault(path, []).append((first, last))
+        if ranges:
+            self.data_hits += len(ranges)
+        return changed, ranges
+
+    def stats(self):
+        return {
+            "generation": self.generation or 0,
+            "files": len(self.files),
+            "rescans": self.rescans,
+            "resolves": self.resolves,
+            "meta_hits": self.meta_hits,
+            "data_hits": self.data_hits,
+        }
@@ -0,0 +1,86 @@
+"""
+Control channel line reader: splits the byte stream into CRLF-terminated commands.
+"""
+
+from transfer import recv_into
+
+MAX_LINE = 512
+_LF = 10
+
+
+class LineTooLong(Exception):
+    pass
+
+
+class CommandReader:
+    # One fixed buffer per session. Several pipelined commands arriving in a
+    # single segment are returned one by one without another read; a command
+    # split across segments is completed before it is returned. Each byte is
+    # scanned for LF only once. A line longer than the buffer is discarded up
+    # to its LF and reported with LineTooLong.
+    def __init__(self, reader, size=MAX_LINE):
+        self.reader = reader
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.scanned = 0
+        self.discarding = False
+
+    def _find_lf(self):
+        buf = self.buf
+        i = self.scanned
+        end = self.end
+        while i < end:
+            if buf[i] == _LF:
+                self.scanned = i + 1
+                return i
+            i += 1
+        self.scanned = end
+        return -1
+
+    def _make_room(self):
+        if self.discarding:
+            self.start = self.end = self.scanned = 0
+            return
+        if not self.start:
+            self.discarding = True
+            self.start = self.end = self.scanned = 0
+            return
+        n = self.end - self.start
+        self.buf[:n] = bytes(self.mv[self.start:self.end])
+        self.start = 0
+        self.end = self.scanned = n
+
+    async def readline(self):
+        # Returns the next command without its line terminator, or None once
+        # the peer has closed the connection.
+        while True:
+            lf = self._find_lf()
+            if lf >= 0:
+                start = self.start
+                self.start = lf + 1
+                if self.discarding:
+                    self.discarding = False
+                    raise LineTooLong()
+                end = lf
+                if end > start and self.buf[end - 1] == 13:
+                    end -= 1
+                return bytes(self.mv[start:end])
+            if self.start == self.end:
+                self.start = self.end = self.scanned = 0
+            elif self.end == len(self.buf):
+                self._make_room()
+            n = await recv_into(self.reader, self.mv[self.end:])
+            if not n:
+                return None
+            self.end += n
+
+
+def parse_command(line):
+    # "retr name with spaces" -> ("RETR", "name with spaces")
+    text = line.decode("ascii", "ignore").strip()
+    sep = text.find(" ")
+    if sep < 0:
+        return text.upper(), ""
+    return text[:sep].upper(), text[sep + 1:].strip()
@@ -1,267 +1,966 @@
 import os
-import socket
+import time
+import gc
+import hashlib
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
 from logger import Logger
-from tamper import FileTamper
+from dirindex import DirIndex
+from ftpcmd import CommandReader, LineTooLong, parse_command
+import compress
+from tamper import FileTamper, TamperError
+from transfer import (DEFAULT_BLOCK_SIZE, DEFAULT_PIPELINE_DEPTH, check_block_size,
+                      send_file, recv_file, send_lines, hash_file, rate)
+from bufpool import BufferPool, mem_available, SESSION_RESERVE
+from scheduler import TransferScheduler, ScheduledReader, ScheduledWriter, SEND_SLOTS
+from metrics import Metrics
+from utils import ticks_ms, ticks_diff
 
-class FTPServer:
-    def __init__(self, username, password, port=21):
-        self.port = port
-        self.server_socket = None
-        self.username = username
-        self.password = password
+PASV_PORT_START = 50000
+PASV_PORT_COUNT = 8
+DATA_CONN_TIMEOUT = 10
+# Stan hashy przerwanych uploadów trzymany do wznowienia przez REST + STOR.
+MAX_PARTIAL_UPLOADS = 2
+MAX_SESSIONS = 8
+# Liczba jednoczesnych transferów (zestawów buforów w puli).
+TRANSFER_SLOTS = 4
+# Komendy, które na czas wykonania biorą bufory z puli.
+BUFFER_COMMANDS = ("RETR", "STOR", "LIST", "NLST", "MLSD")
+
+REPLY_TOO_MANY_SESSIONS = b"421 Too many connections, try again later.\r\n"
+REPLY_NO_BUFFERS = b"425 Too many transfers in progress, try again later.\r\n"
+REPLY_BUSY = b"450 Server busy, try again later.\r\n"
+REPLY_NO_MEMORY = b"451 Out of memory, try again later.\r\n"
+
+
+MLST_FACTS = ("type", "size", "modify", "perm")
+# Algorytmy komendy HASH (draft-bryan-ftpext-hash) dostępne w tym hashlib.
+HASH_ALGORITHMS = tuple((name, attr) for name, attr in (
+    ("SHA-1", "sha1"), ("SHA-256", "sha256"), ("SHA-512", "sha512"), ("MD5", "md5"))
+    if hasattr(hashlib, attr))
+
+
+def format_mtime(mtime):
+    return "%04d%02d%02d%02d%02d%02d" % time.localtime(mtime)[:6]
+
+
+def hash_constructor(name):
+    for algo, attr in HASH_ALGORITHMS:
+        if algo == name:
+            return getattr(hashlib, attr)
+    return None
+
+
+def split_offsets(arg):
+    # "plik ze spacjami.txt 100 200" -> ("plik ze spacjami.txt", [100, 200])
+    parts = arg.split(" ")
+    offsets = []
+    while len(parts) > 1 and len(offsets) < 2 and parts[-1].isdigit():
+        offsets.insert(0, int(parts.pop()))
+    return " ".join(parts), offsets
+
+
+class FTPSession:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.user = None
         self.logged_in = False
-        self.pasv_socket = None
+        self.pasv = None
+        self.pasv_open = False
         self.pasv_addr = None
+        self.epsv_all = False
+        peer = writer.get_extra_info('peername')
+        self.peer_host = peer[0] if peer else None
+        self.data_conn = None
+        self.data_ready = asyncio.Event()
+        self.pipe = None
+        self.flow = None
+        self.transfer_label = None
+        self.mlst_facts = MLST_FACTS
+        self.rest_offset = 0
+        self.restart = 0
+        self.mode_z = False
+        self.hash_algo = FileTamper.hash_name()
+        self.pending_range = None
+        self.range = None
+        self.pending_user = None
+        self.running = True
 
-    def start(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(('0.0.0.0', self.port))
-        self.server_socket.listen(1)
-        Logger.log_info(f"Serwer FTP nasłuchuje na porcie {self.port}")
+    async def send(self, data):
+        # Odpowiedzi sterujące mają pierwszeństwo przed kolejnymi blokami
+        # danych w harmonogramie transferów.
+        scheduler = self.server.scheduler
+        scheduler.control_begin()
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        finally:
+            scheduler.control_end()
 
-    def setup_pasv(self, conn):
-        if self.pasv_socket:
+    def mlst_line(self, name, entry):
+        # Fakty RFC 3659: type, size, modify, perm (r=RETR, w=STOR, d=DELE).
+        index = self.server.index
+        facts = []
+        for fact in self.mlst_facts:
+            if fact == "type":
+                facts.append("type=dir" if entry[2] else "type=file")
+            elif fact == "size" and not entry[2]:
+                facts.append(f"size={entry[0]}")
+            elif fact == "modify":
+                mtime = index.mtime(name)
+                if mtime is not None:
+                    facts.append(f"modify={format_mtime(mtime)}")
+            elif fact == "perm":
+                facts.append("perm=el" if entry[2] else "perm=rwd")
+        return ";".join(facts) + "; " + name
+
+    def transfer_buffer(self):
+        # Poza samym przesyłaniem bufory potoku służą do haszowania
+        # i feed_prefix.
+        return self.pipe.bufs[0]
+
+    def hash_buffer(self, pipe=None):
+        # Drugi bufor do haszowania na workerze: jeden jest czytany z karty,
+        # drugi w tym czasie haszowany na drugim rdzeniu.
+        pipe = pipe or self.pipe
+        if self.server.worker is None or pipe.depth < 2:
+            return None
+        return pipe.bufs[1]
+
+    async def with_buffers(self, verb, handler, arg):
+        # Transfer dostaje bufory z puli serwera na czas komendy. Gdy ich
+        # brak albo brakuje pamięci, klient dostaje 425 zamiast MemoryError.
+        self.pipe = self.server.pool.acquire()
+        if self.pipe is None:
+            Metrics.count("transfers_refused")
+            self.close_pasv()
+            await self.send(REPLY_NO_BUFFERS)
+            return
+        self.transfer_label = verb + " " + arg if arg else verb
+        try:
+            await handler(self, arg)
+        finally:
+            self.server.pool.release(self.pipe)
+            self.pipe = None
+
+    def record_stalls(self, op):
+        # Przestoje potoku: "sd" - nadawca/odbiorca czekał na kartę,
+        # "net" - odczyt/zapis karty czekał na sieć.
+        stalls = self.pipe.stalls
+        for device in ("sd", "net"):
+            count, ms = stalls[device]
+            if count:
+                Metrics.count("%s_stall_%s" % (op, device), count)
+                Metrics.count("%s_stall_%s_ms" % (op, device), ms)
+        Logger.log_debug("%s: przestoje sd=%d (%d ms) net=%d (%d ms)", op.upper(),
+                         stalls["sd"][0], stalls["sd"][1], stalls["net"][0], stalls["net"][1])
+
+    def take_data_conn(self, reader, writer):
+        # Wywoływane przez stały nasłuch portu pasywnego przypisanego do sesji.
+        # Połączenie spoza okna PASV/EPSV albo z innego adresu niż kanał
+        # sterujący jest odrzucane.
+        if not self.pasv_open or self.data_conn is not None:
+            return False
+        peer = writer.get_extra_info('peername')
+        if self.peer_host and peer and peer[0] != self.peer_host:
+            Logger.log_alert(f"Odrzucono połączenie danych z {peer[0]}")
+            return False
+        self.data_conn = (reader, writer)
+        self.data_ready.set()
+        return True
+
+    async def setup_pasv(self, extended=False):
+        self.close_pasv()
+        if self.pasv is None:
+            self.pasv = self.server.acquire_pasv(self)
+            if self.pasv is None:
+                await self.send(b"425 No free passive ports.\r\n")
+                return None
+        self.pasv_open = True
+        pasv_port = self.pasv.port
+
+        if extended:
+            self.pasv_addr = (None, pasv_port)
+            response = f"229 Entering Extended Passive Mode (|||{pasv_port}|)\r\n"
+            await self.send(response.encode())
+            return response
+
+        ip = self.server.get_local_ip()
+        if ip == '127.0.0.1':
+            Logger.log_alert("Warning: Using localhost IP - remote connections will fail!")
+
+        self.pasv_addr = (ip, pasv_port)
+        ip_parts = ip.split('.')
+        p1 = pasv_port // 256
+        p2 = pasv_port % 256
+        response = f"227 Entering Passive Mode ({','.join(ip_parts)},{p1},{p2}).\r\n"
+        await self.send(response.encode())
+        return response
+
+    async def accept_data(self):
+        # Transfer idzie przez harmonogram serwera jako osobny przepływ.
+        await asyncio.wait_for(self.data_ready.wait(), DATA_CONN_TIMEOUT)
+        reader, writer = self.data_conn
+        self.flow = self.server.scheduler.open(self.transfer_label, self.user)
+        return ScheduledReader(reader, self.flow), ScheduledWriter(writer, self.flow)
+
+    def close_pasv(self):
+        # Zamyka tylko połączenie danych; nasłuch zostaje przy sesji do
+        # kolejnego PASV/EPSV.
+        if self.data_conn:
             try:
-                self.pasv_socket.close()
+                self.data_conn[1].close()
             except:
                 pass
-            self.pasv_socket = None
-    
-        self.pasv_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.pasv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        pasv_port = 50000 
-        
+            self.data_conn = None
+        if self.flow is not None:
+            self.server.scheduler.close(self.flow)
+            self.flow = None
+        self.data_ready.clear()
+        self.pasv_open = False
+
+    def release_pasv(self):
+        self.close_pasv()
+        if self.pasv is not None:
+            self.server.release_pasv(self.pasv)
+            self.pasv = None
+
+    async def run(self):
+        await self.send(b"220 MicroPython FTP Server\r\n")
+        commands = CommandReader(self.reader)
+
+        while self.running:
+            try:
+                try:
+                    line = await commands.readline()
+                except LineTooLong:
+                    await self.send(b"500 Command line too long.\r\n")
+                    continue
+                if line is None:
+                    break
+                verb, arg = parse_command(line)
+                if not verb:
+                    continue
+                Logger.log_debug("Odebrano komendę: %s %s", verb, arg)
+                # REST dotyczy tylko bezpośrednio następnej komendy.
+                self.restart, self.rest_offset = self.rest_offset, 0
+                self.range, self.pending_range = self.pending_range, None
+
+                handler = COMMANDS.get(verb)
+                if handler is None:
+                    await self.send(b"502 Command not implemented.\r\n")
+                    Logger.log_info("Nieobsługiwana komenda: %s", verb)
+                elif not self.logged_in and verb not in NO_LOGIN_COMMANDS:
+                    await self.send(b"530 Please login with USER and PASS.\r\n")
+                else:
+                    start = ticks_ms()
+                    if verb in BUFFER_COMMANDS:
+                        await self.with_buffers(verb, handler, arg)
+                    else:
+                        await handler(self, arg)
+                    Metrics.observe("cmd_ms " + verb, ticks_diff(ticks_ms(), start))
+
+            except MemoryError:
+                gc.collect()
+                Metrics.count("mem_errors")
+                Logger.log_error("Brak pamięci podczas obsługi komendy")
+                await self.send(REPLY_NO_MEMORY)
+            except Exception as e:
+                Logger.log_alert(f"Błąd podczas obsługi komendy: {e}")
+                await self.send(b"451 Internal server error.\r\n")
+                # Nie przerywaj pętli – pozwól użytkownikowi próbować dalej
+
+    async def cmd_user(self, arg):
+        self.pending_user = arg
+        await self.send(b"331 User name okay, need password.\r\n")
+
+    async def cmd_pass(self, arg):
+        user = self.pending_user
+        if user == self.server.username and arg == self.server.password:
+            self.user = user
+            self.logged_in = True
+            await self.send(b"230 User logged in, proceed.\r\n")
+            Logger.log_info("Zalogowano użytkownika %s", user)
+        else:
+            await self.send(b"530 Login incorrect.\r\n")
+            Logger.log_info("Nieudana próba logowania: %s", user)
+
+    async def cmd_quit(self, arg):
+        await self.send(b"221 Bye!\r\n")
+        Logger.log_info("Klient zakończył sesję.")
+        self.running = False
+
+    # FileZilla commands
+    async def cmd_pwd(self, arg):
+        await self.send(b'257 "/" is the current directory.\r\n')
+
+    async def cmd_type(self, arg):
+        type_code = arg.upper()
+        if type_code in ['A', 'I', 'L 8']:
+            await self.send(f"200 Type set to {type_code}.\r\n".encode())
+            Logger.log_debug("Ustawiono typ transferu: %s", type_code)
+        else:
+            await self.send(b"504 Type not supported.\r\n")
+
+    async def cmd_pasv(self, arg):
+        if self.epsv_all:
+            await self.send(b"501 PASV not allowed after EPSV ALL.\r\n")
+            return
+        if await self.setup_pasv():
+            Logger.log_debug("Ustawiono PASV na %s", self.pasv_addr)
+
+    async def cmd_epsv(self, arg):
+        if arg.upper() == "ALL":
+            self.epsv_all = True
+            await self.send(b"200 EPSV ALL ok.\r\n")
+            return
+        if arg and arg != "1":
+            await self.send(b"522 Network protocol not supported, use (1)\r\n")
+            return
+        if await self.setup_pasv(extended=True):
+            Logger.log_debug("Ustawiono EPSV na porcie %d", self.pasv_addr[1])
+
+    async def cmd_list(self, arg):
+        if not self.pasv_open:
+            await self.send(b"425 Use PASV or EPSV first.\r\n")
+            return
+        await self.send(b"150 Opening data connection.\r\n")
         try:
-            self.pasv_socket.bind(('0.0.0.0', pasv_port))
-            self.pasv_socket.listen(1)
-            ip = self.get_local_ip()
-            
-            if ip == '127.0.0.1':
-                Logger.log_alert("Warning: Using localhost IP - remote connections will fail!")
-                
-            self.pasv_addr = (ip, pasv_port)
-            ip_parts = ip.split('.')
-            p1 = pasv_port // 256
-            p2 = pasv_port % 256
-            response = f"227 Entering Passive Mode ({','.join(ip_parts)},{p1},{p2}).\r\n"
-            conn.send(response.encode())
-            return response
+            data_reader, data_writer = await self.accept_data()
+            await send_lines(data_writer, self.server.index.names(), self.transfer_buffer())
+            await self.send(b"226 Directory send OK.\r\n")
+            Logger.log_info("Wysłano listę plików.")
         except Exception as e:
-            Logger.log_alert(f"PASV setup failed: {e}")
-            raise
+            await self.send(b"451 Error reading directory.\r\n")
+            Logger.log_alert(f"Błąd podczas listowania: {e}")
+        finally:
+            self.close_pasv()
+
+    async def cmd_mlsd(self, arg):
+        if not self.pasv_open:
+            await self.send(b"425 Use PASV or EPSV first.\r\n")
+            return
+        await self.send(b"150 Opening data connection.\r\n")
+        try:
+            data_reader, data_writer = await self.accept_data()
+            lines = (self.mlst_line(name, entry)
+                     for name, entry in self.server.index.refresh().items())
+            await send_lines(data_writer, lines, self.transfer_buffer())
+            await self.send(b"226 Directory send OK.\r\n")
+            Logger.log_info("Wysłano listę plików (MLSD).")
+        except Exception as e:
+            await self.send(b"451 Error reading directory.\r\n")
+            Logger.log_alert(f"Błąd podczas listowania: {e}")
+        finally:
+            self.close_pasv()
+
+    async def cmd_mlst(self, arg):
+        filename = arg.lstrip('/')
+        if filename in ("", "sd"):
+            line = "type=cdir;perm=cel; /"
+        else:
+            entry = self.server.index.get(filename)
+            if entry is None:
+                await self.send(b"550 File not found.\r\n")
+                return
+            line = self.mlst_line(filename, entry)
+        await self.send(f"250-Listing {filename or '/'}\r\n {line}\r\n250 End\r\n".encode())
+
+    async def cmd_opts(self, arg):
+        option, _, value = arg.partition(" ")
+        option = option.upper()
+        if option == "HASH":
+            name = value.strip().upper()
+            if name and hash_constructor(name) is None:
+                await self.send(b"501 Unknown algorithm.\r\n")
+                return
+            if name:
+                self.hash_algo = name
+            await self.send(f"200 {self.hash_algo}\r\n".encode())
+            return
+        if option != "MLST":
+            await self.send(b"501 Option not understood.\r\n")
+            return
+        requested = [f.lower() for f in value.strip().split(";") if f]
+        self.mlst_facts = tuple(f for f in MLST_FACTS if f in requested)
+        await self.send(f"200 MLST OPTS {''.join(f + ';' for f in self.mlst_facts)}\r\n".encode())
+
+    async def cmd_mode(self, arg):
+        mode = arg.upper()
+        if mode == "S":
+            self.mode_z = False
+            await self.send(b"200 Mode set to S.\r\n")
+        elif mode == "Z" and compress.AVAILABLE:
+            self.mode_z = True
+            await self.send(b"200 Mode set to Z.\r\n")
+        else:
+            await self.send(b"504 Mode not supported.\r\n")
+
+    async def cmd_size(self, arg):
+        filename = arg.lstrip('/')
+        try:
+            if self.server.index.exists(filename):
+                file_size = self.server.index.size(filename)
+                response = f"213 {file_size}\r\n"
+                await self.send(response.encode())
+            else:
+                await self.send(b"550 File not found.\r\n")
+        except Exception as e:
+            await self.send(b"550 Error retrieving file size.\r\n")
+
+    async def cmd_retr(self, arg):
+        filename = arg.lstrip('/')
+        filepath = self.server.root + "/" + filename
+        if not self.pasv_open:
+            await self.send(b"425 Use PASV or EPSV first.\r\n")
+            return
+
+        if not self.server.index.exists(filename):
+            await self.send(b"550 File not found.\r\n")
+            return
+
+        # Z manifestem bloki są weryfikowane w trakcie wysyłania,
+        # bez osobnego odczytu całego pliku.
+        manifest = FileTamper.open_manifest(filepath)
+        if manifest is None:
+            tampered = await FileTamper.check_file_changed_async(
+                filepath, self.transfer_buffer(), self.server.worker, self.hash_buffer())
+        else:
+            tampered = (manifest.file_size != self.server.index.size(filename)
+                        or not manifest.verify_tree())
+        if tampered:
+            if manifest is not None:
+                manifest.close()
+            await self.send(b"550 File verification failed - possible tampering detected.\r\n")
+            Logger.log_alert(f"Próba pobrania zmodyfikowanego pliku: {filename}")
+            return
+
+        if self.restart > self.server.index.size(filename) or (self.restart and self.mode_z):
+            if manifest is not None:
+                manifest.close()
+            await self.send(b"554 Invalid REST parameter.\r\n")
+            return
+
+        await self.send(b"150 Opening data connection.\r\n")
+        try:
+            data_reader, data_writer = await self.accept_data()
+            if self.mode_z:
+                data_writer = compress.DeflateWriter(
+                    data_writer, self.server.deflate_level(filename))
+            verifier = manifest.verifier() if manifest is not None else None
+            with open(filepath, "rb") as f:
+                try:
+                    sent, elapsed = await send_file(
+                        f, data_writer, self.pipe, verifier, self.restart)
+                finally:
+                    self.record_stalls("retr")
+            if self.mode_z:
+                await data_writer.finish()
+                Metrics.observe("deflate_pct", data_writer.sent * 100 // max(sent, 1))
+                Logger.log_info("MODE Z: %d B -> %d B", sent, data_writer.sent)
+            await self.send(b"226 Transfer complete.\r\n")
+            Metrics.observe("retr_bytes", sent)
+            Metrics.observe("retr_Bps", rate(sent, elapsed))
+            Metrics.sample_memory()
+            Logger.log_info("Plik pobrany: %s (%d B, %d B/s)", filename, sent, rate(sent, elapsed))
+        except TamperError as e:
+            Metrics.count("retr_tampered")
+            await self.send(b"451 File verification failed - possible tampering detected.\r\n")
+            Logger.log_alert(f"Przerwano pobieranie zmodyfikowanego pliku {filename}: {e}")
+        except Exception as e:
+            Metrics.count("retr_failed")
+            await self.send(b"451 Error reading file.\r\n")
+            Logger.log_alert(f"Błąd podczas pobierania pliku: {e}")
+        finally:
+            if manifest is not None:
+                manifest.close()
+            self.close_pasv()
+
+    async def cmd_mdtm(self, arg):
+        filename = arg.lstrip('/')
+        try:
+            if self.server.index.exists(filename):
+                mtime = self.server.index.mtime(filename)
+                response = f"213 {format_mtime(mtime)}\r\n"
+                await self.send(response.encode())
+            else:
+                await self.send(b"550 File not found.\r\n")
+        except Exception as e:
+            await self.send(b"550 Error retrieving modification time.\r\n")
+
+    async def cmd_cwd(self, arg):
+        if arg in ["/", "/sd", ""]:
+            await self.send(b"250 Directory successfully changed.\r\n")
+        else:
+            await self.send(b"550 Failed to change directory.\r\n")
+
+    async def cmd_stor(self, arg):
+        filename = arg.lstrip('/')
+        filepath = self.server.root + "/" + filename
+        rest_offset = self.restart
+        if not self.pasv_open:
+            await self.send(b"425 Use PASV or EPSV first.\r\n")
+            return
+        if FileTamper.is_state_path(filepath):
+            await self.send(b"553 File name not allowed.\r\n")
+            return
+        if rest_offset and (self.mode_z or rest_offset != self.server.index.size(filename)):
+            await self.send(b"554 Restart offset must equal the current file size.\r\n")
+            return
+        await self.send(b"150 Ok to send data.\r\n")
+        # Wznowienie po przerwanym uploadzie kontynuuje zachowany
+        # stan hashy; w innym wypadku początek pliku jest
+        # ponownie haszowany z karty.
+        partial = self.server.take_partial_upload(filepath, rest_offset)
+        builder = None
+        self.server.index.begin_write()
+        try:
+            data_reader, data_writer = await self.accept_data()
+            if self.mode_z:
+                data_reader = compress.InflateReader(data_reader)
+            if partial is not None:
+                hash_obj, builder = partial
+            else:
+                hash_obj = FileTamper.new_hash()
+                builder = FileTamper.manifest_builder(filepath)
+            sinks = (hash_obj, builder) if builder is not None else (hash_obj,)
+            if rest_offset and partial is None:
+                FileTamper.feed_prefix(filepath, rest_offset, sinks,
+                                       self.transfer_buffer())
+            with open(filepath, "ab" if rest_offset else "wb") as f:
+                try:
+                    received, elapsed = await recv_file(
+                        data_reader, f, self.pipe, sinks)
+                except OSError:
+                    self.server.save_partial_upload(
+                        filepath, f.tell(), hash_obj, builder)
+                    builder = None
+                    FileTamper.drop_record(filepath)
+                    raise
+                finally:
+                    self.record_stalls("stor")
+            root = None
+            if builder is not None:
+                root = builder.finish()
+                builder = None
+
+            if FileTamper.save_hash(filepath, FileTamper.hexdigest(hash_obj), root):
+                Logger.log_info("Plik zapisany i hash utworzony: %s (%d B, %d B/s)", filename, received, rate(received, elapsed))
+            else:
+                Logger.log_alert(f"Plik zapisany, ale nie udało się utworzyć hash: {filename}")
+
+            await self.send(b"226 Transfer complete.\r\n")
+            Metrics.observe("stor_bytes", received)
+            Metrics.observe("stor_Bps", rate(received, elapsed))
+            Metrics.sample_memory()
+        except Exception as e:
+            Metrics.count("stor_failed")
+            await self.send(b"451 Error writing file.\r\n")
+            Logger.log_alert(f"Błąd podczas zapisu pliku: {e}")
+        finally:
+            if builder is not None:
+                builder.abort()
+            self.server.index.end_write(filename)
+            self.close_pasv()
+
+    async def file_digest(self, filename, algo, start=0, end=None):
+        # Skrót bajtów [start, end) pliku. Dla całego pliku w algorytmie
+        # magazynu skrótów odpowiedź idzie z zapisanego skrótu, jeśli jest
+        # świeży; w przeciwnym razie plik jest czytany blok po bloku.
+        filepath = self.server.root + "/" + filename
+        size = self.server.index.size(filename)
+        if end is None or end > size:
+            end = size
+        start = min(start, end)
+        whole = start == 0 and end == size and algo == FileTamper.hash_name()
+        if whole:
+            digest = FileTamper.fresh_digest(filepath)
+            if digest is not None:
+                Metrics.count("hash_cached")
+                return digest, end
+        # Bez wolnych buforów w puli zwraca (None, end).
+        pipe = self.server.pool.acquire()
+        if pipe is None:
+            Metrics.count("digests_refused")
+            return None, end
+        hash_obj = hash_constructor(algo)()
+        started = ticks_ms()
+        try:
+            with open(filepath, "rb") as f:
+                await hash_file(f, hash_obj, pipe.bufs[0], start, end - start,
+                                self.server.worker, self.hash_buffer(pipe))
+        finally:
+            self.server.pool.release(pipe)
+        Metrics.observe("hash_ms", ticks_diff(ticks_ms(), started))
+        digest = FileTamper.hexdigest(hash_obj)
+        if whole:
+            FileTamper.note_digest(filepath, digest)
+        return digest, end
+
+    async def cmd_hash(self, arg):
+        filename = arg.lstrip('/')
+        if not self.server.index.exists(filename):
+            await self.send(b"550 File not found.\r\n")
+            return
+        start, end = self.range if self.range is not None else (0, None)
+        digest, end = await self.file_digest(filename, self.hash_algo, start, end)
+        if digest is None:
+            await self.send(REPLY_BUSY)
+            return
+        last = max(end - 1, start)
+        await self.send(f"213 {self.hash_algo} {start}-{last} {digest} {filename}\r\n".encode())
+
+    async def cmd_rang(self, arg):
+        try:
+            start, end = [int(x) for x in arg.split()]
+        except ValueError:
+            await self.send(b"501 Invalid RANG parameters.\r\n")
+            return
+        if start == 1 and end == 0:
+            await self.send(b"350 Restarting at 0. End byte range at EOF.\r\n")
+            return
+        if start < 0 or end < start:
+            await self.send(b"501 Invalid RANG parameters.\r\n")
+            return
+        # Koniec zakresu RANG jest włączny.
+        self.pending_range = (start, end + 1)
+        await self.send(f"350 Restarting at {start}. End byte range at {end}.\r\n".encode())
+
+    async def cmd_xhash(self, algo, arg):
+        if hash_constructor(algo) is None:
+            await self.send(b"502 Command not implemented.\r\n")
+            return
+        filename, offsets = split_offsets(arg)
+        filename = filename.lstrip('/')
+        if not self.server.index.exists(filename):
+            await self.send(b"550 File not found.\r\n")
+            return
+        start = offsets[0] if offsets else 0
+        end = offsets[1] if len(offsets) > 1 else None
+        digest, _ = await self.file_digest(filename, algo, start, end)
+        if digest is None:
+            await self.send(REPLY_BUSY)
+            return
+        await self.send(f"250 {digest}\r\n".encode())
+
+    async def cmd_xmd5(self, arg):
+        await self.cmd_xhash("MD5", arg)
+
+    async def cmd_xsha1(self, arg):
+        await self.cmd_xhash("SHA-1", arg)
+
+    async def cmd_xsha256(self, arg):
+        await self.cmd_xhash("SHA-256", arg)
+
+    async def cmd_site(self, arg):
+        sub = arg.split(" ", 1)[0].upper()
+        if sub == "STATS":
+            if arg[5:].strip().upper() == "RESET":
+                Metrics.reset()
+                await self.send(b"200 Statistics reset.\r\n")
+                return
+            lines = ["211-Statistics:"]
+            lines.extend(" " + line for line in Metrics.lines())
+            lines.append("211 End")
+            await self.send(("\r\n".join(lines) + "\r\n").encode())
+        elif sub == "TRANSFERS":
+            lines = ["211-Transfers:"]
+            lines.extend(" " + line for line in self.server.scheduler.flow_lines())
+            lines.append("211 End")
+            await self.send(("\r\n".join(lines) + "\r\n").encode())
+        else:
+            await self.send(b"504 SITE command not implemented.\r\n")
+
+    async def cmd_rest(self, arg):
+        try:
+            offset = int(arg)
+            if offset < 0:
+                raise ValueError
+        except ValueError:
+            await self.send(b"501 Invalid REST parameter.\r\n")
+            return
+        self.rest_offset = offset
+        await self.send(f"350 Restarting at {offset}. Send STORE or RETRIEVE.\r\n".encode())
+
+    async def cmd_dele(self, arg):
+        filename = arg.lstrip('/')
+        filepath = self.server.root + "/" + filename
+        if not self.server.index.exists(filename):
+            await self.send(b"550 File not found.\r\n")
+            return
+        try:
+            os.remove(filepath)
+            FileTamper.drop_file(filepath)
+            self.server.index.remove(filename)
+            await self.send(b"250 File deleted.\r\n")
+            Logger.log_info("Usunięto plik: %s", filename)
+        except Exception as e:
+            self.server.index.invalidate()
+            await self.send(b"550 Delete failed.\r\n")
+            Logger.log_alert(f"Błąd podczas usuwania pliku: {e}")
+
+    async def cmd_syst(self, arg):
+        await self.send(b"215 UNIX Type: L8\r\n")
+
+    async def cmd_feat(self, arg):
+        await self.send(self.server.feat_reply())
+
+    async def cmd_auth(self, arg):
+        await self.send(b"502 SSL/TLS not supported\r\n")
+
+
+# Komenda -> metoda sesji; wyszukanie jest jednym odczytem ze słownika
+# niezależnie od liczby obsługiwanych komend.
+COMMANDS = {
+    "USER": FTPSession.cmd_user,
+    "PASS": FTPSession.cmd_pass,
+    "QUIT": FTPSession.cmd_quit,
+    "PWD": FTPSession.cmd_pwd,
+    "TYPE": FTPSession.cmd_type,
+    "PASV": FTPSession.cmd_pasv,
+    "EPSV": FTPSession.cmd_epsv,
+    "LIST": FTPSession.cmd_list,
+    "NLST": FTPSession.cmd_list,
+    "MLSD": FTPSession.cmd_mlsd,
+    "MLST": FTPSession.cmd_mlst,
+    "OPTS": FTPSession.cmd_opts,
+    "MODE": FTPSession.cmd_mode,
+    "SIZE": FTPSession.cmd_size,
+    "RETR": FTPSession.cmd_retr,
+    "MDTM": FTPSession.cmd_mdtm,
+    "CWD": FTPSession.cmd_cwd,
+    "STOR": FTPSession.cmd_stor,
+    "REST": FTPSession.cmd_rest,
+    "HASH": FTPSession.cmd_hash,
+    "RANG": FTPSession.cmd_rang,
+    "XMD5": FTPSession.cmd_xmd5,
+    "XSHA1": FTPSession.cmd_xsha1,
+    "XSHA256": FTPSession.cmd_xsha256,
+    "DELE": FTPSession.cmd_dele,
+    "SYST": FTPSession.cmd_syst,
+    "SITE": FTPSession.cmd_site,
+    "FEAT": FTPSession.cmd_feat,
+    "AUTH": FTPSession.cmd_auth,
+}
+NO_LOGIN_COMMANDS = ("USER", "PASS", "QUIT")
+
+
+class FTPServer:
+    def __init__(self, username, password, port=21,
+                 pasv_port_start=PASV_PORT_START, pasv_port_count=PASV_PORT_COUNT,
+                 block_size=DEFAULT_BLOCK_SIZE, deflate_level=compress.DEFAULT_LEVEL,
+                 root="/sd", worker=None, pipeline_depth=DEFAULT_PIPELINE_DEPTH,
+                 max_sessions=MAX_SESSIONS, transfer_slots=TRANSFER_SLOTS,
+                 send_slots=SEND_SLOTS, rate_limit=0, user_rate_limits=None):
+        self.port = port
+        self.root = root
+        if root != FileTamper.ROOT:
+            FileTamper.set_root(root)
+        self.block_size = check_block_size(block_size)
+        if self.block_size % FileTamper.LEAF_SIZE:
+            raise ValueError("block size must be a multiple of the manifest leaf size")
+        self.server = None
+        self.username = username
+        self.password = password
+        self.pasv_ports = range(pasv_port_start, pasv_port_start + pasv_port_count)
+        self.free_pasv = []
+        self.local_ip = None
+        self.level = deflate_level
+        self.pipeline_depth = pipeline_depth
+        self.max_sessions = max_sessions
+        # Bufory transferów alokowane od razu, póki sterta nie jest pofragmentowana.
+        self.pool = BufferPool(transfer_slots, pipeline_depth, self.block_size)
+        self.feat = None
+        # Kolejność wysyłki bloków między transferami (DRR) i limity prędkości.
+        self.scheduler = TransferScheduler(send_slots, rate_limit, user_rate_limits)
+        self.sessions = []
+        self.partial_uploads = []
+        # Stan detektora zmian (/sd/.tamper) nie jest udostępniany klientom.
+        self.index = DirIndex(root, lambda name: FileTamper.is_state_path(root + "/" + name))
+        Metrics.register("ftp", self.stats)
+        Metrics.register("pool", self.pool.stats)
+        Metrics.register("sched", self.scheduler.stats)
+        # Opcjonalny Worker (drugi rdzeń) do haszowania przy RETR i HASH.
+        self.worker = worker
+        if worker is not None:
+            Metrics.register("worker", worker.stats)
+
+    async def start(self, backlog=4):
+        self.server = await asyncio.start_server(
+            self._handle_client, '0.0.0.0', self.port, backlog=backlog)
+        Logger.log_info(f"Serwer FTP nasłuchuje na porcie {self.port}")
+        # Porty pasywne są otwierane raz, przy starcie, a nie przy każdym
+        # transferze.
+        for port in self.pasv_ports:
+            listener = PasvListener(port)
+            try:
+                await listener.open()
+            except Exception as e:
+                Logger.log_alert(f"Nie udało się otworzyć portu pasywnego {port}: {e}")
+                continue
+            self.free_pasv.append(listener)
+        Logger.log_info(f"Porty pasywne gotowe: {len(self.free_pasv)}")
+
+    async def serve_forever(self):
+        await self.server.wait_closed()
+
+    def stop(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        for listener in self.free_pasv:
+            listener.close()
+        for session in self.sessions:
+            if session.pasv is not None:
+                session.pasv.close()
+        self.free_pasv = []
+
+    def features(self):
+        features = [
+            "EPSV",
+            "HASH " + ";".join(name + "*" if name == FileTamper.hash_name() else name
+                               for name, _ in HASH_ALGORITHMS),
+            "MDTM",
+            "MLST " + "".join(f + "*;" for f in MLST_FACTS),
+            "RANG STREAM",
+            "REST STREAM",
+            "SIZE",
+        ]
+        if compress.AVAILABLE:
+            features.insert(3, "MODE Z")
+        return features
+
+    def feat_reply(self):
+        # Lista FEAT nie zmienia się w trakcie pracy, więc jest kodowana raz.
+        if self.feat is None:
+            lines = ["211-Features:"]
+            for feature in self.features():
+                lines.append(" " + feature)
+            lines.append("211 End")
+            self.feat = ("\r\n".join(lines) + "\r\n").encode()
+        return self.feat
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "pasv_free": len(self.free_pasv),
+            "partial_uploads": len(self.partial_uploads),
+            "dir_scans": self.index.scans,
+            "pipeline_depth": self.pipeline_depth,
+        }
+
+    def deflate_level(self, filename):
+        # Pliki już skompresowane idą blokami bez kompresji.
+        return 0 if compress.is_compressed_name(filename) else self.level
+
+    def save_partial_upload(self, path, size, hash_obj, builder):
+        self.take_partial_upload(path, None)
+        self.partial_uploads.append((path, size, hash_obj, builder))
+        while len(self.partial_uploads) > MAX_PARTIAL_UPLOADS:
+            old = self.partial_uploads.pop(0)
+            if old[3] is not None:
+                old[3].abort()
+
+    def take_partial_upload(self, path, size):
+        for i, entry in enumerate(self.partial_uploads):
+            if entry[0] == path:
+                del self.partial_uploads[i]
+                if entry[1] == size:
+                    return entry[2], entry[3]
+                if entry[3] is not None:
+                    entry[3].abort()
+                return None
+        return None
+
+    def acquire_pasv(self, session):
+        if not self.free_pasv:
+            return None
+        listener = self.free_pasv.pop(0)
+        listener.session = session
+        return listener
+
+    def release_pasv(self, listener):
+        listener.session = None
+        if listener.server is not None and listener not in self.free_pasv:
+            self.free_pasv.append(listener)
+
+    def set_local_ip(self, ip):
+        # Wołane po (ponownym) połączeniu z Wi-Fi; None wymusza ponowne
+        # odpytanie interfejsu przy następnym PASV.
+        self.local_ip = ip
 
     def get_local_ip(self):
+        if self.local_ip is not None:
+            return self.local_ip
         import network
         sta_if = network.WLAN(network.STA_IF)
         if not sta_if.active():
             sta_if.active(True)
         if sta_if.isconnected():
-            return sta_if.ifconfig()[0]
+            self.local_ip = sta_if.ifconfig()[0]
+            return self.local_ip
         Logger.log_alert("WiFi not connected! Falling back to 127.0.0.1")
-        return '127.0.0.1'  
-    
-    def poll(self):
+        return '127.0.0.1'
+
+    async def _handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        Logger.log_info("Nowe połączenie od %s", addr)
+        if len(self.sessions) >= self.max_sessions or not mem_available(SESSION_RESERVE):
+            # Przy braku miejsca lepiej odmówić jednemu klientowi niż
+            # skończyć na MemoryError i restarcie całego urządzenia.
+            Metrics.count("sessions_refused")
+            Logger.log_warning("Odrzucono połączenie od %s (limit sesji lub pamięci)", addr)
+            try:
+                writer.write(REPLY_TOO_MANY_SESSIONS)
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+            return
+        session = FTPSession(self, reader, writer)
+        self.sessions.append(session)
         try:
-            conn, addr = self.server_socket.accept()
-            Logger.log_info(f"Nowe połączenie od {addr}")
-            conn.send(b"220 MicroPython FTP Server\r\n")
-            self.logged_in = False
-            user = None
+            await session.run()
+        except Exception as e:
+            Logger.log_alert(f"Socket error: {e}")
+        finally:
+            session.release_pasv()
+            self.sessions.remove(session)
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+            Logger.log_info("Połączenie zamknięte.")
 
-            while True:
-                try:
-                    data = conn.recv(1024)
-                    if not data:
-                        break
-                    command = data.decode('ascii', 'ignore').strip()
-                    Logger.log_info(f"Odebrano komendę: {command}")
-
-                    if command.upper().startswith("USER"):
-                        user = command[5:].strip()
-                        conn.send(b"331 User name okay, need password.\r\n")
-
-                    elif command.upper().startswith("PASS"):
-                        passwd = command[5:].strip()
-                        if user == self.username and passwd == self.password:
-                            self.logged_in = True
-                            conn.send(b"230 User logged in, proceed.\r\n")
-                            Logger.log_info(f"Zalogowano użytkownika {user}")
-                        else:
-                            conn.send(b"530 Login incorrect.\r\n")
-                            Logger.log_info(f"Nieudana próba logowania: {user}/{passwd}")
-
-                    elif command.upper().startswith("QUIT"):
-                        conn.send(b"221 Bye!\r\n")
-                        Logger.log_info("Klient zakończył sesję.")
-                        break
-
-                    elif not self.logged_in:
-                        conn.send(b"530 Please login with USER and PASS.\r\n")
-                    
-                    # FileZilla commands
-                    elif command.upper().startswith("PWD"):
-                        conn.send(b'257 "/" is the current directory.\r\n')
-
-                    elif command.upper().startswith("TYPE"):
-                        type_code = command[5:].strip().upper()
-                        if type_code in ['A', 'I', 'L 8']:
-                            conn.send(f"200 Type set to {type_code}.\r\n".encode())
-                            Logger.log_info(f"Ustawiono typ transferu: {type_code}")
-                        else:
-                            conn.send(b"504 Type not supported.\r\n")
-
-
-                    elif command.upper().startswith("PASV"):
-                        if self.pasv_socket:
-                            self.pasv_socket.close()
-                            self.pasv_socket = None
-                        response = self.setup_pasv(conn)
-                        Logger.log_info(f"Ustawiono PASV na {self.pasv_addr}")
-
-                    elif command.upper().startswith("LIST") or command.upper().startswith("NLST"):
-                        if not self.pasv_socket:
-                            conn.send(b"425 Use PASV first.\r\n")
-                            continue
-                        conn.send(b"150 Opening data connection.\r\n")
-                        data_conn, data_addr = self.pasv_socket.accept()
-                        try:
-                            files = os.listdir("/sd")
-                            listing = "\r\n".join(files) + "\r\n"
-                            data_conn.sendall(listing.encode())
-                            conn.send(b"226 Directory send OK.\r\n")
-                            Logger.log_info("Wysłano listę plików.")
-                        except Exception as e:
-                            conn.send(b"451 Error reading directory.\r\n")
-                            Logger.log_alert(f"Błąd podczas listowania: {e}")
-                        finally:
-                            data_conn.close()
-                            self.pasv_socket.close()
-                            self.pasv_socket = None
-
-                    elif command.upper().startswith("SIZE"):
-                        if not self.pasv_socket:
-                            conn.send(b"425 Use PASV first.\r\n")
-                            continue
-                        filename = command[5:].strip().lstrip('/')
-                        filepath = "/sd/" + filename
-                        try:
-                            if filename in os.listdir("/sd"):
-                                file_size = os.stat(filepath)[6]
-                                response = f"213 {file_size}\r\n"
-                                conn.send(response.encode())
-                            else:
-                                conn.send(b"550 File not found.\r\n")
-                        except Exception as e:
-                            conn.send(b"550 Error retrieving file size.\r\n")
-
-                    elif command.upper().startswith("RETR"):
-                        filename = command[5:].strip().lstrip('/')
-                        filepath = "/sd/" + filename
-                        if not self.pasv_socket:
-                            conn.send(b"425 Use PASV first.\r\n")
-                            continue
-
-                        if filename not in os.listdir("/sd"):
-                            conn.send(b"550 File not found.\r\n")
-                            continue
-                            
-                        if FileTamper.check_file_changed(filepath):
-                            conn.send(b"550 File verification failed - possible tampering detected.\r\n")
-                            Logger.log_alert(f"Próba pobrania zmodyfikowanego pliku: {filename}")
-                            continue
-                            
-                        conn.send(b"150 Opening data connection.\r\n")
-                        data_conn, data_addr = self.pasv_socket.accept()
-                        try:
-                            with open(filepath, "rb") as f:
-                                while True:
-                                    chunk = f.read(512)
-                                    if not chunk:
-                                        break
-                                    data_conn.send(chunk)
-                            conn.send(b"226 Transfer complete.\r\n")
-                            Logger.log_info(f"Plik pobrany: {filename}")
-                        except Exception as e:
-                            conn.send(b"451 Error reading file.\r\n")
-                            Logger.log_alert(f"Błąd podczas pobierania pliku: {e}")
-                        finally:
-                            data_conn.close()
-                            self.pasv_socket.close()
-                            self.pasv_socket = None
-
-                    elif command.upper().startswith("MDTM"):
-                        filename = command[5:].strip().lstrip('/')
-                        filepath = "/sd/" + filename
-                        try:
-                            if filename in os.listdir("/sd"):
-                                mtime = os.stat(filepath)[8]
-                                import time
-                                timestamp = time.localtime(mtime)
-                                formatted_time = time.strftime("%Y%m%d%H%M%S", timestamp)
-                                response = f"213 {formatted_time}\r\n"
-                                conn.send(response.encode())
-                            else:
-                                conn.send(b"550 File not found.\r\n")
-                        except Exception as e:
-                            conn.send(b"550 Error retrieving modification time.\r\n")
-
-                    elif command.upper().startswith("CWD"):
-                        path = command[4:].strip()
-                        if path in ["/", "/sd", ""]:
-                            conn.send(b"250 Directory successfully changed.\r\n")
-                        else:
-                            conn.send(b"550 Failed to change directory.\r\n")
-
-
-                    elif command.upper().startswith("STOR"):
-                        filename = command[5:].strip()
-                        filepath = "/sd/" + filename
-                        if not self.pasv_socket:
-                            conn.send(b"425 Use PASV first.\r\n")
-                            continue
-                        conn.send(b"150 Ok to send data.\r\n")
-                        data_conn, data_addr = self.pasv_socket.accept()
-                        try:
-                            with open(filepath, "wb") as f:
-                                while True:
-                                    data = data_conn.recv(512)
-                                    if not data:
-                                        break
-                                    f.write(data)
-                            
-                            if FileTamper.init_file_hash(filepath):
-                                Logger.log_info(f"Plik zapisany i hash utworzony: {filename}")
-                            else:
-                                Logger.log_alert(f"Plik zapisany, ale nie udało się utworzyć hash: {filename}")
-                            
-                            conn.send(b"226 Transfer complete.\r\n")
-                        except Exception as e:
-                            conn.send(b"451 Error writing file.\r\n")
-                            Logger.log_alert(f"Błąd podczas zapisu pliku: {e}")
-                        finally:
-                            data_conn.close()
-                            self.pasv_socket.close()
-                            self.pasv_socket = None
-
-                    elif command.upper().startswith("SYST"):
-                        conn.send(b"215 UNIX Type: L8\r\n")
-                    elif command.upper().startswith("FEAT"):
-                        conn.send(b"211 No features\r\n")
-                    elif command.upper() == "AUTH TLS" or command.upper() == "AUTH SSL":
-                        conn.send(b"502 SSL/TLS not supported\r\n")
-                        
-                    else:
-                        conn.send(b"502 Command not implemented.\r\n")
-                        Logger.log_info(f"Nieobsługiwana komenda: {command}")
 
-                except Exception as e:
-                    Logger.log_alert(f"Błąd podczas obsługi komendy: {e}")
-                    conn.send(b"451 Internal server error.\r\n")
-                    # Nie przerywaj pętli – pozwól użytkownikowi próbować dalej
+class PasvListener:
+    # Stały nasłuch na jednym porcie pasywnym. Przychodzące połączenie trafia
+    # do sesji, której port jest aktualnie przydzielony; bez właściciela jest
+    # od razu zamykane.
+    def __init__(self, port):
+        self.port = port
+        self.server = None
+        self.session = None
 
-        except Exception as e:
-            Logger.log_alert(f"Socket error: {e}")
+    async def open(self):
+        self.server = await asyncio.start_server(
+            self._on_conn, '0.0.0.0', self.port, backlog=2)
 
-        finally:
-            conn.close()
-            Logger.log_info("Połączenie zamknięte.")
\ No newline at end of file
+    async def _on_conn(self, reader, writer):
+        session = self.session
+        if session is None or not session.take_data_conn(reader, writer):
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.close()
+            except:
+                pass
+            self.server = None
@@ -1,25 +1,160 @@
-import logging
+import time
+from utils import ticks_ms, ticks_diff
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+ALERT = 50
+
+_LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR", ALERT: "ALERT"}
+
 
 class Logger:
-    _logger = None
+    # Lines are appended to a fixed RAM ring and written to the log file in
+    # one go: when FLUSH_BYTES have piled up, when flush() is called (main
+    # does so every few seconds) and straight away for ERROR and ALERT. If the
+    # file cannot be written the ring keeps the newest lines and drops the
+    # oldest. Messages are %-formatted only if their level is enabled, and
+    # one message template repeated more than RATE_BURST times within
+    # RATE_WINDOW_MS is suppressed, with a count logged once the window ends.
+    RING_SIZE = 4096
+    FLUSH_BYTES = 2048
+    RATE_WINDOW_MS = 1000
+    RATE_BURST = 10
+    MAX_RATE_KEYS = 32
+
+    level = INFO
+    _path = None
+    _ring = bytearray(RING_SIZE)
+    _start = 0
+    _used = 0
+    # template -> [window_start, count, suppressed]
+    _rates = {}
+    dropped = 0
+    suppressed = 0
+
+    @staticmethod
+    def init(log_file='ftp_server.log', level=INFO):
+        Logger._path = log_file
+        Logger.level = level
 
     @staticmethod
-    def init(log_file='ftp_server.log'):
-        logging.basicConfig(
-            filename=log_file,
-            level=logging.DEBUG,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
-        Logger._logger = logging.getLogger()
+    def set_level(level):
+        Logger.level = level
 
     @staticmethod
-    def log_info(message):
-        Logger._logger.info(message)
+    def log_debug(message, *args):
+        if Logger.level <= DEBUG:
+            Logger._log(DEBUG, message, args)
 
     @staticmethod
-    def log_warning(message):
-        Logger._logger.warning(message)
-    
+    def log_info(message, *args):
+        if Logger.level <= INFO:
+            Logger._log(INFO, message, args)
+
+    @staticmethod
+    def log_warning(message, *args):
+        if Logger.level <= WARNING:
+            Logger._log(WARNING, message, args)
+
+    @staticmethod
+    def log_error(message, *args):
+        if Logger.level <= ERROR:
+            Logger._log(ERROR, message, args)
+
+    @staticmethod
+    def log_alert(message, *args):
+        if Logger.level <= ALERT:
+            Logger._log(ALERT, message, args)
+
+    @staticmethod
+    def _log(level, message, args):
+        repeats = Logger._rate_check(message)
+        if repeats is None:
+            return
+        text = message % args if args else message
+        if repeats:
+            text = "%s (%d similar messages suppressed)" % (text, repeats)
+        t = time.localtime()
+        line = "%04d-%02d-%02d %02d:%02d:%02d - %s - %s\n" % (
+            t[0], t[1], t[2], t[3], t[4], t[5], _LEVEL_NAMES[level], text)
+        Logger._append(line.encode())
+        if level >= ERROR or Logger._used >= Logger.FLUSH_BYTES:
+            Logger.flush()
+
+    @staticmethod
+    def _rate_check(message):
+        # Returns None to drop the message, otherwise how many repeats of it
+        # were suppressed in the window that just ended.
+        now = ticks_ms()
+        rates = Logger._rates
+        entry = rates.get(message)
+        if entry is None or ticks_diff(now, entry[0]) >= Logger.RATE_WINDOW_MS:
+            repeats = entry[2] if entry is not None else 0
+            if entry is None and len(rates) >= Logger.MAX_RATE_KEYS:
+                rates.clear()
+            rates[message] = [now, 1, 0]
+            return repeats
+        entry[1] += 1
+        if entry[1] <= Logger.RATE_BURST:
+            return 0
+        entry[2] += 1
+        Logger.suppressed += 1
+        return None
+
+    @staticmethod
+    def _append(data):
+        ring = Logger._ring
+        size = len(ring)
+        n = len(data)
+        if n >= size:
+            data = data[n - size + 1:]
+            n = len(data)
+        if Logger._used + n > size:
+            Logger.flush()
+            if Logger._used + n > size:
+                Logger._drop(Logger._used + n - size)
+        end = (Logger._start + Logger._used) % size
+        first = min(n, size - end)
+        ring[end:end + first] = data[:first]
+        if first < n:
+            ring[:n - first] = data[first:]
+        Logger._used += n
+
+    @staticmethod
+    def _drop(nbytes):
+        # Drops at least nbytes of the oldest lines, always whole lines.
+        ring = Logger._ring
+        size = len(ring)
+        pos = Logger._start
+        dropped = 0
+        while Logger._used - dropped > 0:
+            byte = ring[pos]
+            pos = (pos + 1) % size
+            dropped += 1
+            if byte == 10 and dropped >= nbytes:
+                break
+        Logger._start = pos if Logger._used - dropped else 0
+        Logger._used -= dropped
+        Logger.dropped += dropped
+
     @staticmethod
-    def log_error(message):
-        Logger._logger.error(message)
+    def flush():
+        if not Logger._used or Logger._path is None:
+            return
+        mv = memoryview(Logger._ring)
+        start = Logger._start
+        end = start + Logger._used
+        size = len(mv)
+        try:
+            with open(Logger._path, "ab") as f:
+                if end <= size:
+                    f.write(mv[start:end])
+                else:
+                    f.write(mv[start:])
+                    f.write(mv[:end - size])
+        except OSError:
+            return
+        Logger._start = 0
+        Logger._used = 0
@@ -2,43 +2,96 @@
 import time
 
 import machine
+import network
 import os
 import sdcard
-from logger import Logger
+from blockcache import BlockCache
+from logger import Logger, INFO
 import time
 
-from ftpserver import FTPServer
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+from ftpserver import FTPServer, PASV_PORT_START, PASV_PORT_COUNT, MAX_SESSIONS, TRANSFER_SLOTS
 from wifi import connect_wifi
-from tamper import FileTamper
+from tamper import FileTamper, TamperScanner
+from transfer import DEFAULT_BLOCK_SIZE, DEFAULT_PIPELINE_DEPTH
+from compress import DEFAULT_LEVEL
 from utils import load_env
+from metrics import Metrics
+from scheduler import SEND_SLOTS, rate_caps
+from worker import Worker
+from fatmap import FatVolume, DirtyResolver
 
 MONITORED_FILES = ["/sd/document.txt"]
+TAMPER_SCAN_INTERVAL = 0.1
+WIFI_CHECK_INTERVAL = 5
+LOG_FLUSH_INTERVAL = 5
+METRICS_DUMP_INTERVAL = 300
+# RAM na cache sektorów karty SD; 0 wyłącza cache.
+SD_CACHE_BYTES = 16 * 1024
 
 def mount_sdcard():
+    # Zwraca (karta, urządzenie zamontowane jako /sd) albo None.
     spi = machine.SPI(1, sck=machine.Pin(10), mosi=machine.Pin(11), miso=machine.Pin(12))
     cs = machine.Pin(13, machine.Pin.OUT)
     try:
-        sd = sdcard.SDCard(spi, cs)
+        card = sdcard.SDCard(spi, cs, baudrates=sdcard.BAUDRATE_LADDER)
+        Logger.log_info(f"Karta SD: SPI {card.baudrate} Hz")
+        Metrics.register("sd", card.stats)
+        sd = card
+        if SD_CACHE_BYTES:
+            sd = BlockCache(card, SD_CACHE_BYTES)
+            Metrics.register("cache", sd.stats)
         os.mount(sd, "/sd")
         Logger.log_info("Karta SD zamontowana.")
-        return True
+        return card, sd
     except Exception as e:
         Logger.log_alert(f"Nie wykryto karty SD lub błąd montowania: {e}")
-        return False
+        return None
+
+
+def start_write_tracking(card, dev):
+    # Sterownik zaznacza zapisane sektory, a skaner sprawdza tylko pliki,
+    # których one dotyczą. Bez obsługiwanego FAT skanuje wszystko w kółko.
+    try:
+        resolver = DirtyResolver(card, FatVolume(dev), FileTamper.ROOT)
+    except (OSError, ValueError) as e:
+        Logger.log_alert(f"Śledzenie zapisów niedostępne: {e}")
+        return None
+    card.enable_dirty_tracking()
+    Metrics.register("dirty", resolver.stats)
+    Logger.log_info("Śledzenie zapisów na karcie włączone.")
+    return resolver
 
 
 def main():
-    if not mount_sdcard():
+    mounted = mount_sdcard()
+    if not mounted:
         return
 
     env = load_env(".env")
+    Logger.set_level(int(env.get("LOG_LEVEL", INFO)))
     ssid = env["SSID"]
     password = env["PASSWORD"]
     ftp_user = env["FTP_USER"]
     ftp_pass = env["FTP_PASS"]
     ftp_port = int(env["FTP_PORT"])
+    block_size = int(env.get("FTP_BLOCK_SIZE", DEFAULT_BLOCK_SIZE))
+    pasv_port_start = int(env.get("FTP_PASV_PORT_START", PASV_PORT_START))
+    pasv_port_count = int(env.get("FTP_PASV_PORT_COUNT", PASV_PORT_COUNT))
+    deflate_level = int(env.get("FTP_DEFLATE_LEVEL", DEFAULT_LEVEL))
+    use_worker = int(env.get("FTP_WORKER", 1))
+    pipeline_depth = int(env.get("FTP_PIPELINE_DEPTH", DEFAULT_PIPELINE_DEPTH))
+    max_sessions = int(env.get("FTP_MAX_SESSIONS", MAX_SESSIONS))
+    transfer_slots = int(env.get("FTP_TRANSFER_SLOTS", TRANSFER_SLOTS))
+    send_slots = int(env.get("FTP_SEND_SLOTS", SEND_SLOTS))
+    rate_limit, user_rate_limits = rate_caps(env)
+    dirty_tracking = int(env.get("FTP_DIRTY_TRACKING", 1))
     print(ssid, password, ftp_user, ftp_pass, ftp_port, sep='\n')
-    connect_wifi(ssid, password)
+    local_ip = connect_wifi(ssid, password)
 
 
     for filename in MONITORED_FILES:
@@ -46,24 +99,92 @@ def main():
             with open(filename, "w") as f:
                 f.write("Plik chroniony tamper detection!\n")
 
+    FileTamper.load()
     for filename in MONITORED_FILES:
         if FileTamper.init_file_hash(filename):
             Logger.log_info(f"Zainicjowano hash dla pliku {filename}")
         else:
             Logger.log_alert(f"Błąd inicjalizacji hash dla pliku {filename}")
     
-    ftp = FTPServer(username=ftp_user, password=ftp_pass, port=ftp_port)
-    ftp.start()
-    Logger.log_info("Serwer FTP uruchomiony.")
+    worker = None
+    if use_worker:
+        worker = Worker()
+        if worker.start():
+            Logger.log_info("Worker haszujący uruchomiony na drugim rdzeniu.")
+        else:
+            worker = None
+
+    resolver = start_write_tracking(*mounted) if dirty_tracking else None
+
+    ftp = FTPServer(username=ftp_user, password=ftp_pass, port=ftp_port,
+                    pasv_port_start=pasv_port_start, pasv_port_count=pasv_port_count,
+                    block_size=block_size, deflate_level=deflate_level, worker=worker,
+                    pipeline_depth=pipeline_depth, max_sessions=max_sessions,
+                    transfer_slots=transfer_slots, send_slots=send_slots,
+                    rate_limit=rate_limit, user_rate_limits=user_rate_limits)
+    ftp.set_local_ip(local_ip)
 
     try:
-        while True: 
-            ftp.poll()
-            time.sleep(2)
-            for filename in MONITORED_FILES:
-                FileTamper.check_file_changed(filename)
+        asyncio.run(run_server(ftp, ssid, password, resolver))
     except KeyboardInterrupt:
+        ftp.stop()
+        if worker is not None:
+            worker.stop()
         Logger.log_info("Serwer zatrzymany.")
+        Logger.flush()
+
+
+async def monitor_files(worker, resolver):
+    # Skanuje wszystkie pliki z zapisanym hashem, po kawałku na każdy tick,
+    # żeby nie blokować obsługi FTP. Z workerem haszowanie idzie na drugim
+    # rdzeniu, a tu zostaje tylko czytanie z karty. Ze śledzeniem zapisów
+    # bezczynna karta nie kosztuje nic poza sprawdzeniem bitmapy.
+    scanner = TamperScanner(resolver=resolver)
+    while True:
+        if worker is not None and worker.running:
+            await scanner.tick_async(worker)
+        else:
+            scanner.tick()
+        await asyncio.sleep(TAMPER_SCAN_INTERVAL)
+
+
+async def dump_metrics():
+    while True:
+        await asyncio.sleep(METRICS_DUMP_INTERVAL)
+        Logger.log_info("STATS %s", " | ".join(Metrics.lines()))
+
+
+async def flush_logs():
+    # Logi trafiają na kartę paczkami, a nie przy każdej komendzie.
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        Logger.flush()
+
+
+async def watch_wifi(ftp, ssid, password):
+    # Po utracie Wi-Fi łączy ponownie i podaje serwerowi nowy adres do
+    # odpowiedzi PASV.
+    wlan = network.WLAN(network.STA_IF)
+    while True:
+        await asyncio.sleep(WIFI_CHECK_INTERVAL)
+        if wlan.isconnected():
+            continue
+        Logger.log_alert("Utracono połączenie Wi-Fi, łączę ponownie.")
+        ftp.set_local_ip(None)
+        try:
+            ftp.set_local_ip(connect_wifi(ssid, password))
+        except Exception as e:
+            Logger.log_alert(f"Ponowne łączenie z Wi-Fi nie powiodło się: {e}")
+
+
+async def run_server(ftp, ssid, password, resolver):
+    await ftp.start()
+    Logger.log_info("Serwer FTP uruchomiony.")
+    asyncio.create_task(monitor_files(ftp.worker, resolver))
+    asyncio.create_task(flush_logs())
+    asyncio.create_task(dump_metrics())
+    asyncio.create_task(watch_wifi(ftp, ssid, password))
+    await ftp.serve_forever()
 
 if __name__ == "__main__":
     Logger.init()
@@ -0,0 +1,108 @@
+"""
+In-RAM counters and histograms behind SITE STATS and the periodic stats dump.
+"""
+
+import gc
+from utils import ticks_ms, ticks_diff
+
+_BUCKETS = 32
+
+
+class Histogram:
+    # Log2 buckets: bucket i counts values of bit length i, so percentiles
+    # are reported as the upper bound of their bucket.
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * _BUCKETS
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        i = 0
+        while value > 0 and i < _BUCKETS - 1:
+            value >>= 1
+            i += 1
+        self.buckets[i] += 1
+
+    def percentile(self, pct):
+        target = (self.count * pct + 99) // 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                if i == _BUCKETS - 1:
+                    return self.max
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+    def format(self):
+        return "n=%d avg=%d p50<=%d p90<=%d max=%d" % (
+            self.count, self.total // max(self.count, 1),
+            self.percentile(50), self.percentile(90), self.max)
+
+
+class Metrics:
+    # Counters and histograms are created on first use. Components that keep
+    # their own statistics (SD card, block cache, FTP server) register a
+    # stats() callable returning a flat dict, read only when a report is made.
+    counters = {}
+    histograms = {}
+    sources = {}
+    mem_low = None
+    started = ticks_ms()
+
+    @staticmethod
+    def count(name, n=1):
+        Metrics.counters[name] = Metrics.counters.get(name, 0) + n
+
+    @staticmethod
+    def observe(name, value):
+        hist = Metrics.histograms.get(name)
+        if hist is None:
+            hist = Metrics.histograms[name] = Histogram()
+        hist.add(value)
+
+    @staticmethod
+    def register(name, stats):
+        Metrics.sources[name] = stats
+
+    @staticmethod
+    def sample_memory():
+        mem_free = getattr(gc, "mem_free", None)
+        if mem_free is None:
+            return None
+        free = mem_free()
+        if Metrics.mem_low is None or free < Metrics.mem_low:
+            Metrics.mem_low = free
+        return free
+
+    @staticmethod
+    def reset():
+        Metrics.counters = {}
+        Metrics.histograms = {}
+        Metrics.mem_low = None
+        Metrics.started = ticks_ms()
+
+    @staticmethod
+    def lines():
+        free = Metrics.sample_memory()
+        out = ["uptime_s=%d" % (ticks_diff(ticks_ms(), Metrics.started) // 1000)]
+        if free is not None:
+            out.append("mem free=%d low=%d" % (free, Metrics.mem_low))
+        if Metrics.counters:
+            out.append(" ".join("%s=%d" % (k, Metrics.counters[k])
+                                for k in sorted(Metrics.counters)))
+        for name in sorted(Metrics.sources):
+            try:
+                stats = Metrics.sources[name]()
+            except Exception as e:
+                out.append("%s error=%s" % (name, e))
+                continue
+            out.append(name + " " + " ".join("%s=%s" % (k, stats[k]) for k in sorted(stats)))
+        for name in sorted(Metrics.histograms):
+            out.append(name + " " + Metrics.histograms[name].format())
+        return out
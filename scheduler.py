@@ -0,0 +1,305 @@
+"""
+Deficit round-robin send scheduling and rate caps for FTP data connections.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+from utils import ticks_ms, ticks_diff
+from transfer import SECTOR_SIZE, recv_into
+
+SEND_SLOTS = 1
+# A slot held this long (its client stopped reading, so drain() blocks) no
+# longer counts, and control replies stop holding back data after this long.
+SLOT_WAIT_MS = 500
+USER_RATE_PREFIX = "FTP_USER_RATE_LIMIT_"
+
+
+def rate_caps(env):
+    # (global B/s, {user: B/s}) from FTP_RATE_LIMIT, FTP_USER_RATE_LIMIT (any
+    # user) and FTP_USER_RATE_LIMIT_<user>; 0 or missing means no cap.
+    users = {}
+    default = int(env.get("FTP_USER_RATE_LIMIT", 0))
+    if default:
+        users["*"] = default
+    for key in env:
+        if key.startswith(USER_RATE_PREFIX):
+            users[key[len(USER_RATE_PREFIX):]] = int(env[key])
+    return int(env.get("FTP_RATE_LIMIT", 0)), users
+
+
+class RateLimiter:
+    # Token bucket holding at most burst bytes. take() may overdraw it and
+    # returns how long to wait before the bytes are covered.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = ticks_ms()
+
+    def take(self, n):
+        now = ticks_ms()
+        self.tokens = min(self.burst, self.tokens + ticks_diff(now, self.last) * self.rate // 1000)
+        self.last = now
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens * 1000 // self.rate
+
+
+class Flow:
+    def __init__(self, sched, label, user):
+        self.sched = sched
+        self.label = label
+        self.user = user
+        self.deficit = 0
+        self.want = 0
+        self.sending = False
+        self.reserved = False
+        self.stalled = False
+        self.granted_at = 0
+        self.granted = asyncio.Event()
+        self.bytes = 0
+        self.waits = 0
+        self.wait_ms = 0
+        self.started = ticks_ms()
+
+    def rate(self):
+        return self.bytes * 1000 // max(ticks_diff(ticks_ms(), self.started), 1)
+
+
+class TransferScheduler:
+    # Sending a chunk on a data connection takes one of `slots` send slots
+    # for the write and its drain, which keeps at most that many chunks
+    # queued in the network stack ahead of anyone else. Flows waiting for a
+    # slot are served in deficit round-robin order: the round visits every
+    # open flow in turn, a waiting flow gains quantum bytes of credit per
+    # visit and goes when its credit covers its chunk, so flows get equal
+    # bytes whatever their chunk sizes (a flow sending 4 KiB blocks goes
+    # once for every eight 512 B chunks of another one). A flow reached
+    # just as it finishes a chunk has its next one still to come, so with
+    # enough credit the slot is kept for it until it asks; an idle flow
+    # loses its credit. An uncontended flow goes straight away.
+    # While a control reply is being sent no slot is handed out, so replies
+    # only wait for chunks already on their way. Neither a stuck reply nor
+    # a stuck holder blocks the others for more than SLOT_WAIT_MS.
+    # Rate caps (global and per user, in B/s) are token buckets checked
+    # before a slot is requested, and for received data after each read.
+    def __init__(self, slots=SEND_SLOTS, rate_limit=0, user_limits=None, quantum=SECTOR_SIZE):
+        self.slots = slots
+        self.quantum = quantum
+        self.busy = 0
+        self.control = 0
+        self.control_at = 0
+        self.waiting = []
+        self.flows = []
+        self.turn = 0
+        self.limiter = RateLimiter(rate_limit, max(quantum, rate_limit // 10)) if rate_limit else None
+        self.user_limits = user_limits or {}
+        self.user_limiters = {}
+        self.grants = 0
+        self.overruns = 0
+        self.throttled_ms = 0
+
+    def open(self, label, user):
+        flow = Flow(self, label, user)
+        self.flows.append(flow)
+        return flow
+
+    def close(self, flow):
+        if flow in self.flows:
+            self.flows.remove(flow)
+        if flow in self.waiting:
+            self.waiting.remove(flow)
+        self._unreserve(flow)
+
+    def _unreserve(self, flow):
+        if flow.reserved:
+            flow.reserved = False
+            self.busy -= 1
+            self._dispatch()
+
+    def _user_limiter(self, user):
+        limiter = self.user_limiters.get(user)
+        if limiter is None:
+            rate = self.user_limits.get(user, self.user_limits.get("*", 0))
+            if not rate:
+                return None
+            limiter = self.user_limiters[user] = RateLimiter(rate, max(self.quantum, rate // 10))
+        return limiter
+
+    async def throttle(self, flow, n):
+        delay = 0
+        if self.limiter is not None:
+            delay = self.limiter.take(n)
+        limiter = self._user_limiter(flow.user) if self.user_limits else None
+        if limiter is not None:
+            delay = max(delay, limiter.take(n))
+        if delay:
+            # A kept slot is not held through the wait.
+            self._unreserve(flow)
+            self.throttled_ms += delay
+            await asyncio.sleep(delay / 1000)
+
+    def _control_active(self):
+        return self.control and ticks_diff(ticks_ms(), self.control_at) < SLOT_WAIT_MS
+
+    def _dispatch(self):
+        flows = self.flows
+        while self.busy < self.slots and self.waiting and not self._control_active():
+            self.turn %= len(flows)
+            flow = flows[self.turn]
+            self.turn += 1
+            if flow not in self.waiting:
+                if flow.reserved or flow.stalled:
+                    continue
+                if not flow.sending:
+                    flow.deficit = 0
+                else:
+                    flow.deficit += self.quantum
+                    if flow.deficit >= flow.want:
+                        flow.reserved = True
+                        flow.granted_at = ticks_ms()
+                        self.busy += 1
+                continue
+            flow.deficit += self.quantum
+            if flow.deficit >= flow.want:
+                self.waiting.remove(flow)
+                flow.deficit -= flow.want
+                self._grant(flow)
+                flow.granted.set()
+
+    def _grant(self, flow):
+        flow.sending = True
+        flow.granted_at = ticks_ms()
+        self.busy += 1
+        self.grants += 1
+
+    def _evict_stalled(self):
+        now = ticks_ms()
+        for flow in self.flows:
+            if ticks_diff(now, flow.granted_at) < SLOT_WAIT_MS:
+                continue
+            if flow.reserved:
+                flow.reserved = False
+                self.busy -= 1
+            elif flow.sending and not flow.stalled:
+                flow.stalled = True
+                self.busy -= 1
+                self.overruns += 1
+        self._dispatch()
+
+    async def acquire(self, flow, n):
+        await self.throttle(flow, n)
+        if flow.reserved:
+            flow.reserved = False
+            if flow.deficit >= n:
+                flow.deficit -= n
+                flow.sending = True
+                flow.granted_at = ticks_ms()
+                self.grants += 1
+                return
+            self.busy -= 1
+        flow.want = n
+        if self.busy < self.slots and not self.waiting and not self._control_active():
+            flow.deficit = 0
+            self._grant(flow)
+            return
+        flow.granted.clear()
+        self.waiting.append(flow)
+        start = ticks_ms()
+        self._dispatch()
+        while not flow.granted.is_set():
+            try:
+                await asyncio.wait_for(flow.granted.wait(), SLOT_WAIT_MS / 1000)
+            except asyncio.TimeoutError:
+                self._evict_stalled()
+        flow.waits += 1
+        flow.wait_ms += ticks_diff(ticks_ms(), start)
+
+    def release(self, flow, n):
+        flow.bytes += n
+        if flow.stalled:
+            flow.stalled = False
+        else:
+            self.busy -= 1
+        self._dispatch()
+        flow.sending = False
+
+    def control_begin(self):
+        if not self.control:
+            self.control_at = ticks_ms()
+        self.control += 1
+
+    def control_end(self):
+        self.control -= 1
+        self._dispatch()
+
+    def stats(self):
+        return {
+            "flows": len(self.flows),
+            "busy": self.busy,
+            "waiting": len(self.waiting),
+            "grants": self.grants,
+            "overruns": self.overruns,
+            "throttled_ms": self.throttled_ms,
+        }
+
+    def flow_lines(self):
+        return ["%s user=%s bytes=%d rate=%d B/s waits=%d wait_ms=%d" % (
+            flow.label, flow.user, flow.bytes, flow.rate(), flow.waits, flow.wait_ms)
+            for flow in self.flows]
+
+
+class ScheduledWriter:
+    # Stands in for the data connection writer: written data is held until
+    # drain(), which sends it in a scheduler slot.
+    def __init__(self, writer, flow):
+        self.writer = writer
+        self.flow = flow
+        self.pending = []
+        self.size = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.size += len(data)
+
+    async def drain(self):
+        if not self.pending:
+            return
+        sched = self.flow.sched
+        n = self.size
+        await sched.acquire(self.flow, n)
+        try:
+            for data in self.pending:
+                self.writer.write(data)
+            self.pending = []
+            self.size = 0
+            await self.writer.drain()
+        finally:
+            sched.release(self.flow, n)
+
+    def close(self):
+        self.writer.close()
+
+    async def wait_closed(self):
+        await self.writer.wait_closed()
+
+    def get_extra_info(self, name):
+        return self.writer.get_extra_info(name)
+
+
+class ScheduledReader:
+    # Stands in for the data connection reader: received bytes count
+    # towards the flow and its rate caps.
+    def __init__(self, reader, flow):
+        self.reader = reader
+        self.flow = flow
+
+    async def readinto(self, mv):
+        n = await recv_into(self.reader, mv)
+        if n:
+            self.flow.bytes += n
+            await self.flow.sched.throttle(self.flow, n)
+        return n
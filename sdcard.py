@@ -11,20 +11,143 @@ _R1_ILLEGAL_COMMAND = const(1 << 2)
 _TOKEN_CMD25 = const(0xFC)
 _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
+# Token polls done back to back before falling back to 1 ms sleeps; a card
+# that is just fetching data answers well within this.
+_TOKEN_SPINS = const(2000)
+# Blocks read back at every candidate rate while negotiating the baudrate.
+_TEST_BLOCKS = const(8)
+
+# SPI clock rates tried, slowest first, when negotiating the baudrate.
+BAUDRATE_LADDER = (1320000, 4000000, 8000000, 12000000, 20000000, 25000000)
+
+# RAM for the dirty-block bitmap; a bit covers a power-of-two run of sectors
+# chosen so that the whole card fits.
+DIRTY_MAP_BYTES = 1024
+
+_crc16_table = None
+# Shared by all SDCard instances, so a remounted card never reuses a value.
+_generation = 0
+
+
+def _crc7(buf, n):
+    crc = 0
+    for i in range(n):
+        d = buf[i]
+        for _ in range(8):
+            crc <<= 1
+            if (d ^ crc) & 0x80:
+                crc ^= 0x09
+            d <<= 1
+        crc &= 0x7F
+    return crc
+
+
+def _crc16(buf):
+    global _crc16_table
+    table = _crc16_table
+    if table is None:
+        table = []
+        for i in range(256):
+            c = i << 8
+            for _ in range(8):
+                c = ((c << 1) ^ 0x1021) if c & 0x8000 else (c << 1)
+            table.append(c & 0xFFFF)
+        _crc16_table = table
+    crc = 0
+    for b in buf:
+        crc = ((crc << 8) & 0xFFFF) ^ table[((crc >> 8) ^ b) & 0xFF]
+    return crc
+
+
+def _next_generation():
+    global _generation
+    _generation += 1
+    return _generation
+
 
 class SDCard:
-    def __init__(self, spi, cs, baudrate=1320000):
+    def __init__(self, spi, cs, baudrate=1320000, baudrates=None, crc=False):
         self.spi = spi
         self.cs = cs
         self.cmdbuf = bytearray(6)
-        self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
-        for i in range(512):
-            self.dummybuf[i] = 0xFF
-        self.dummybuf_memoryview = memoryview(self.dummybuf)
+        self.crcbuf = bytearray(2)
+        self.busybuf = bytearray(8)
+        self.crc = False
+        self.crc_errors = 0
+        self.blocks_read = 0
+        self.blocks_written = 0
+        self.read_cmds = 0
+        self.write_cmds = 0
+        self.retries = 0
+        self.baudrates = [baudrate]
+        self.rate_index = 0
+        self.dirty_map = None
+        self.dirty_shift = 0
+        self.dirty_any = False
+        self.generation = 0
         # initialise the card
         print("[SD] Inicjalizacja SDCard (SPI)")
         self.init_card(baudrate)
+        if baudrates:
+            self.negotiate_baudrate(baudrates)
+        if crc:
+            self.set_crc(True)
+
+    @property
+    def baudrate(self):
+        return self.baudrates[self.rate_index]
+
+    def set_crc(self, enabled):
+        # CMD59: with CRC on the card rejects commands and data blocks with a
+        # bad checksum, and every block read is checked here.
+        self.crc = True
+        if self.cmd(59, 1 if enabled else 0, 0) != 0:
+            self.crc = False
+            print("[SD] Karta nie obsługuje trybu CRC (CMD59)")
+            return False
+        self.crc = enabled
+        return True
+
+    def negotiate_baudrate(self, ladder):
+        # Step the clock up while _TEST_BLOCKS read back identically and with
+        # valid CRCs; the first failing rate ends the climb.
+        crc = self.crc
+        self.set_crc(True)
+        reference = bytearray(_TEST_BLOCKS * 512)
+        self.readblocks(0, reference)
+        probe = bytearray(_TEST_BLOCKS * 512)
+        single = bytearray(512)
+        good = [self.baudrate]
+        for rate in ladder:
+            if rate <= good[-1]:
+                continue
+            self.init_spi(rate)
+            try:
+                self._readblocks(0, probe)
+                self._readblocks(_TEST_BLOCKS - 1, single)
+                ok = probe == reference and single == reference[-512:]
+            except OSError:
+                ok = False
+            if not ok:
+                print(f"[SD] Baudrate {rate} niestabilny")
+                break
+            good.append(rate)
+        self.baudrates = good
+        self.rate_index = len(good) - 1
+        self.init_spi(self.baudrate)
+        if self.crc and not crc:
+            self.set_crc(False)
+        print(f"[SD] Wybrany baudrate: {self.baudrate}")
+        return self.baudrate
+
+    def _downshift(self):
+        if self.rate_index == 0:
+            return False
+        self.rate_index -= 1
+        self.init_spi(self.baudrate)
+        print(f"[SD] Błędy transmisji, obniżam baudrate do {self.baudrate}")
+        return True
 
     def init_spi(self, baudrate):
         try:
@@ -91,6 +214,7 @@ class SDCard:
             raise OSError("can't set 512 block size")
         print("[SD] Ustawiam szybki SPI")
         self.init_spi(baudrate)
+        self.generation = _next_generation()
         print("[SD] Karta SD zainicjalizowana pomyślnie!")
 
     def init_card_v1(self):
@@ -129,11 +253,11 @@ class SDCard:
         self.cs(0)
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
-        buf[5] = crc
+        buf[1] = (arg >> 24) & 0xFF
+        buf[2] = (arg >> 16) & 0xFF
+        buf[3] = (arg >> 8) & 0xFF
+        buf[4] = arg & 0xFF
+        buf[5] = (_crc7(buf, 5) << 1) | 1 if self.crc else crc
         self.spi.write(buf)
         if skip1:
             self.spi.readinto(self.tokenbuf, 0xFF)
@@ -154,51 +278,171 @@ class SDCard:
         self.spi.write(b"\xff")
         return -1
 
-    def readinto(self, buf):
-        self.cs(0)
+    def _wait_token(self):
+        tokenbuf = self.tokenbuf
+        for i in range(_TOKEN_SPINS):
+            self.spi.readinto(tokenbuf, 0xFF)
+            if tokenbuf[0] == _TOKEN_DATA:
+                return True
         for i in range(_CMD_TIMEOUT):
-            self.spi.readinto(self.tokenbuf, 0xFF)
-            if self.tokenbuf[0] == _TOKEN_DATA:
-                break
+            self.spi.readinto(tokenbuf, 0xFF)
+            if tokenbuf[0] == _TOKEN_DATA:
+                return True
             time.sleep_ms(1)
-        else:
+        return False
+
+    def _read_block(self, buf):
+        # CS stays asserted: multi-block reads stream every block of a CMD18
+        # without releasing the card in between.
+        if not self._wait_token():
             self.cs(1)
             print("[SD] Timeout oczekiwania na odpowiedź DATA")
             raise OSError("timeout waiting for response")
-        mv = self.dummybuf_memoryview
-        if len(buf) != len(mv):
-            mv = mv[: len(buf)]
-        self.spi.write_readinto(mv, buf)
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.readinto(buf, 0xFF)
+        self.spi.readinto(self.crcbuf, 0xFF)
+        if self.crc and _crc16(buf) != (self.crcbuf[0] << 8 | self.crcbuf[1]):
+            self.crc_errors += 1
+            self.cs(1)
+            raise OSError(5)  # EIO
+
+    def _wait_ready(self):
+        # The card holds MISO low while busy; polling several bytes per call
+        # cuts the per-byte interpreter overhead of the spin.
+        busybuf = self.busybuf
+        while True:
+            self.spi.readinto(busybuf, 0xFF)
+            if busybuf[-1]:
+                return
+
+    def _write_block(self, token, buf):
+        self.tokenbuf[0] = token
+        self.spi.write(self.tokenbuf)
+        self.spi.write(buf)
+        if self.crc:
+            crc = _crc16(buf)
+            self.crcbuf[0] = crc >> 8
+            self.crcbuf[1] = crc & 0xFF
+            self.spi.write(self.crcbuf)
+        else:
+            self.spi.write(b"\xff\xff")
+        self.spi.readinto(self.tokenbuf, 0xFF)
+        if (self.tokenbuf[0] & 0x1F) != 0x05:
+            return False
+        self._wait_ready()
+        return True
+
+    def readinto(self, buf):
+        self.cs(0)
+        self._read_block(buf)
         self.cs(1)
         self.spi.write(b"\xff")
 
     def write(self, token, buf):
         self.cs(0)
-        self.spi.read(1, token)
-        self.spi.write(buf)
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
-        if (self.spi.read(1, 0xFF)[0] & 0x1F) != 0x05:
-            self.cs(1)
-            self.spi.write(b"\xff")
-            return
-        while self.spi.read(1, 0xFF)[0] == 0:
-            pass
+        ok = self._write_block(token, buf)
         self.cs(1)
         self.spi.write(b"\xff")
+        return ok
 
     def write_token(self, token):
         self.cs(0)
-        self.spi.read(1, token)
+        self.tokenbuf[0] = token
+        self.spi.write(self.tokenbuf)
         self.spi.write(b"\xff")
-        while self.spi.read(1, 0xFF)[0] == 0x00:
-            pass
+        self._wait_ready()
         self.cs(1)
         self.spi.write(b"\xff")
 
+    def enable_dirty_tracking(self, map_bytes=DIRTY_MAP_BYTES):
+        # Every block written from now on is marked in a bitmap of
+        # map_bytes * 8 bits, which take_dirty() hands out. Writes made
+        # before this are unknown, hence the new generation.
+        shift = 0
+        while (self.sectors - 1) >> shift >= map_bytes * 8:
+            shift += 1
+        self.dirty_shift = shift
+        self.dirty_map = bytearray(map_bytes)
+        self.dirty_any = False
+        self.generation = _next_generation()
+
+    def _mark_dirty(self, block_num, nblocks):
+        dirty_map = self.dirty_map
+        for g in range(block_num >> self.dirty_shift, ((block_num + nblocks - 1) >> self.dirty_shift) + 1):
+            dirty_map[g >> 3] |= 1 << (g & 7)
+        self.dirty_any = True
+
+    def take_dirty(self):
+        # Sector ranges [start, end) written since the last call, merged and
+        # rounded out to whole bitmap granules; clears the bitmap.
+        if not self.dirty_any:
+            return []
+        ranges = []
+        dirty_map = self.dirty_map
+        shift = self.dirty_shift
+        for i in range(len(dirty_map)):
+            byte = dirty_map[i]
+            if not byte:
+                continue
+            dirty_map[i] = 0
+            for bit in range(8):
+                if byte & (1 << bit):
+                    start = (i * 8 + bit) << shift
+                    end = min(start + (1 << shift), self.sectors)
+                    if ranges and ranges[-1][1] == start:
+                        ranges[-1] = (ranges[-1][0], end)
+                    else:
+                        ranges.append((start, end))
+        self.dirty_any = False
+        return ranges
+
     def readblocks(self, block_num, buf):
+        self.read_cmds += 1
+        self.blocks_read += len(buf) // 512
+        try:
+            try:
+                self._readblocks(block_num, buf)
+            except OSError:
+                if not self._downshift():
+                    raise
+                self.retries += 1
+                self._readblocks(block_num, buf)
+        except OSError:
+            self.generation = _next_generation()
+            raise
+
+    def writeblocks(self, block_num, buf):
+        # A failed command may mean the card was pulled or swapped, and a
+        # failed write may have landed anyway: either way the card contents
+        # are no longer known, so the generation moves on.
+        self.write_cmds += 1
+        self.blocks_written += len(buf) // 512
+        if self.dirty_map is not None:
+            self._mark_dirty(block_num, len(buf) // 512)
+        try:
+            try:
+                self._writeblocks(block_num, buf)
+            except OSError:
+                if not self._downshift():
+                    raise
+                self.retries += 1
+                self._writeblocks(block_num, buf)
+        except OSError:
+            self.generation = _next_generation()
+            raise
+
+    def stats(self):
+        return {
+            "baudrate": self.baudrate,
+            "blocks_read": self.blocks_read,
+            "blocks_written": self.blocks_written,
+            "read_cmds": self.read_cmds,
+            "write_cmds": self.write_cmds,
+            "crc_errors": self.crc_errors,
+            "retries": self.retries,
+            "generation": self.generation,
+        }
+
+    def _readblocks(self, block_num, buf):
         self.spi.write(b"\xff")
         nblocks = len(buf) // 512
         assert nblocks and not len(buf) % 512, "Buffer length is invalid"
@@ -213,30 +457,40 @@ class SDCard:
                 raise OSError(5)  # EIO
             offset = 0
             mv = memoryview(buf)
-            while nblocks:
-                self.readinto(mv[offset : offset + 512])
-                offset += 512
-                nblocks -= 1
+            try:
+                while nblocks:
+                    self._read_block(mv[offset : offset + 512])
+                    offset += 512
+                    nblocks -= 1
+            except OSError:
+                self.cmd(12, 0, 0xFF, skip1=True)
+                raise
             if self.cmd(12, 0, 0xFF, skip1=True):
                 raise OSError(5)  # EIO
 
-    def writeblocks(self, block_num, buf):
+    def _writeblocks(self, block_num, buf):
         self.spi.write(b"\xff")
         nblocks, err = divmod(len(buf), 512)
         assert nblocks and not err, "Buffer length is invalid"
         if nblocks == 1:
             if self.cmd(24, block_num * self.cdv, 0) != 0:
                 raise OSError(5)  # EIO
-            self.write(_TOKEN_DATA, buf)
+            if not self.write(_TOKEN_DATA, buf):
+                raise OSError(5)  # EIO
         else:
-            if self.cmd(25, block_num * self.cdv, 0) != 0:
+            if self.cmd(25, block_num * self.cdv, 0, release=False) != 0:
+                self.cs(1)
                 raise OSError(5)  # EIO
             offset = 0
             mv = memoryview(buf)
             while nblocks:
-                self.write(_TOKEN_CMD25, mv[offset : offset + 512])
+                if not self._write_block(_TOKEN_CMD25, mv[offset : offset + 512]):
+                    self.cs(1)
+                    self.write_token(_TOKEN_STOP_TRAN)
+                    raise OSError(5)  # EIO
                 offset += 512
                 nblocks -= 1
+            self.cs(1)
             self.write_token(_TOKEN_STOP_TRAN)
 
     def ioctl(self, op, arg):
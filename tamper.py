@@ -5,85 +5,928 @@ except ImportError:
     import uhashlib as hashlib
 import binascii
 import os
+import struct
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ucollections import OrderedDict
 from logger import Logger
+from utils import ticks_ms, ticks_diff
+from metrics import Metrics
+from transfer import hash_file
+
+# magic, digest size, reserved, leaf size, file size, leaf count
+_MANIFEST_HEADER = "<4sHHIII"
+_MANIFEST_HEADER_SIZE = struct.calcsize(_MANIFEST_HEADER)
+_MANIFEST_MAGIC = b"MRK1"
+
+# magic, record size, record count
+_STORE_HEADER = "<4sHI"
+_STORE_HEADER_SIZE = struct.calcsize(_STORE_HEADER)
+_STORE_MAGIC = b"TDB1"
+# path, digest length, digest, Merkle root, size, mtime
+_STORE_RECORD = "<64sB32s32sII"
+_STORE_RECORD_SIZE = struct.calcsize(_STORE_RECORD)
+
+
+class TamperError(Exception):
+    pass
+
 
 class FileTamper:
-    HASH_DIR = "/sd/"
-    
+    # Everything the tamper detector keeps on the card lives under STATE_DIR,
+    # which the FTP server does not serve: the digest store and the per-file
+    # Merkle manifests (one digest per LEAF_SIZE block of the file, followed
+    # by each level of the tree up to the root).
+    ROOT = "/sd"
+    STATE_DIR = "/sd/.tamper"
+    STORE_FILE = "/sd/.tamper/digests.bin"
+    LEAF_SIZE = 4096
+    # Per-file .hash files written by earlier versions; imported on first load.
+    LEGACY_HASH_DIR = "/sd/"
+    # Known digests stay resident for up to CACHE_SIZE files; a cached result
+    # is trusted while the file's (size, mtime) is unchanged and it is younger
+    # than CACHE_MAX_AGE_MS. The age limit catches same-size rewrites that fall
+    # inside FAT's 2-second mtime granularity.
+    CACHE_SIZE = 32
+    CACHE_MAX_AGE_MS = 60000
+    # path -> [stored_hash, current_hash, (size, mtime), checked_at]
+    _cache = OrderedDict()
+    _store = None
+
+    @staticmethod
+    def set_root(root):
+        # Moves the detector to another served directory; the host
+        # benchmarks use this to run against a temporary directory.
+        FileTamper.ROOT = root
+        FileTamper.STATE_DIR = root + "/.tamper"
+        FileTamper.STORE_FILE = FileTamper.STATE_DIR + "/digests.bin"
+        FileTamper.LEGACY_HASH_DIR = root + "/"
+        FileTamper._store = None
+        FileTamper._cache = OrderedDict()
+
+    @staticmethod
+    def load():
+        FileTamper._ensure_dir(FileTamper.STATE_DIR)
+        store = DigestStore(FileTamper.STORE_FILE)
+        store.load()
+        FileTamper._store = store
+        FileTamper._import_legacy_hashes()
+        Logger.log_info(f"Loaded {len(store.index)} hash records from {store.path}")
+        return store
+
+    @staticmethod
+    def store():
+        if FileTamper._store is None:
+            FileTamper.load()
+        return FileTamper._store
+
+    @staticmethod
+    def _import_legacy_hashes():
+        store = FileTamper._store
+        try:
+            names = os.listdir(FileTamper.LEGACY_HASH_DIR)
+        except OSError:
+            return
+        for name in names:
+            if not (name.startswith("sd_") and name.endswith(".hash")):
+                continue
+            hash_file = FileTamper.LEGACY_HASH_DIR + name
+            filename = FileTamper.ROOT + "/" + name[3:-5]
+            try:
+                with open(hash_file, "r") as f:
+                    digest = f.read().strip()
+                if store.get(filename) is None:
+                    stat = FileTamper._stat(filename) or (0, 0)
+                    store.put(filename, digest, None, stat[0], stat[1])
+                os.remove(hash_file)
+                Logger.log_info(f"Imported legacy hash file {hash_file}")
+            except Exception as e:
+                Logger.log_alert(f"Error importing legacy hash file {hash_file}: {e}")
+
+    @staticmethod
+    def is_state_path(filename):
+        return (filename == FileTamper.STATE_DIR
+                or filename.startswith(FileTamper.STATE_DIR + "/"))
+
     @staticmethod
-    def _ensure_hash_dir():
+    def _ensure_dir(path):
         try:
             try:
-                os.listdir(FileTamper.HASH_DIR)
+                os.listdir(path)
             except OSError:
-                os.mkdir(FileTamper.HASH_DIR)
-                Logger.log_info(f"Created hash directory: {FileTamper.HASH_DIR}")
+                os.mkdir(path)
+                Logger.log_info(f"Created hash directory: {path}")
         except Exception as e:
             Logger.log_alert(f"Error ensuring hash directory: {e}")
 
     @staticmethod
-    def _get_hash_filename(original_filename):
+    def _get_manifest_filename(original_filename):
         base_name = original_filename.lstrip("/").replace("/", "_")
-        return FileTamper.HASH_DIR + base_name + ".hash"
+        return FileTamper.STATE_DIR + "/" + base_name + ".mrk"
+
+    @staticmethod
+    def manifest_builder(filename):
+        FileTamper._ensure_dir(FileTamper.STATE_DIR)
+        try:
+            return MerkleBuilder(FileTamper._get_manifest_filename(filename),
+                                 FileTamper.LEAF_SIZE)
+        except Exception as e:
+            Logger.log_alert(f"Error creating manifest for {filename}: {e}")
+            return None
+
+    @staticmethod
+    def open_manifest(filename):
+        # The manifest is only trusted if its root matches the one recorded in
+        # the digest store; otherwise callers fall back to a full-file check.
+        record = FileTamper.store().get(filename)
+        if record is None or record[1] is None:
+            return None
+        try:
+            manifest = MerkleManifest.open(FileTamper._get_manifest_filename(filename))
+        except OSError:
+            return None
+        except Exception as e:
+            Logger.log_alert(f"Invalid manifest for {filename}: {e}")
+            return None
+        if manifest.root() != record[1]:
+            manifest.close()
+            Logger.log_alert(f"Manifest root mismatch for {filename}")
+            return None
+        return manifest
+
+    @staticmethod
+    def verify_range(filename, first, count, buf=None):
+        manifest = FileTamper.open_manifest(filename)
+        if manifest is None:
+            Logger.log_alert(f"No manifest found for {filename}")
+            return False
+        try:
+            with open(filename, "rb") as f:
+                bad = manifest.verify_range(f, first, count, buf)
+        except OSError as e:
+            Logger.log_alert(f"Range verification error for {filename}: {e}")
+            return False
+        finally:
+            manifest.close()
+        if bad >= 0:
+            Logger.log_alert(f"FILE '{filename}' HAS BEEN MODIFIED! (block {bad})")
+            return False
+        return True
 
     @staticmethod
-    def _compute_hash(filename):
+    def _stat(filename):
         try:
+            st = os.stat(filename)
+            return (st[6], st[8])
+        except OSError:
+            return None
+
+    @staticmethod
+    def _cache_get(filename):
+        entry = FileTamper._cache.pop(filename, None)
+        if entry is not None:
+            FileTamper._cache[filename] = entry
+        return entry
+
+    @staticmethod
+    def _cache_put(filename, stored_hash, current_hash, stat):
+        cache = FileTamper._cache
+        cache.pop(filename, None)
+        cache[filename] = [stored_hash, current_hash, stat, ticks_ms()]
+        while len(cache) > FileTamper.CACHE_SIZE:
+            del cache[next(iter(cache))]
+
+    @staticmethod
+    def forget(filename):
+        FileTamper._cache.pop(filename, None)
+
+    @staticmethod
+    def drop_record(filename):
+        FileTamper.forget(filename)
+        try:
+            FileTamper.store().remove(filename)
+        except OSError:
+            pass
+
+    @staticmethod
+    def drop_file(filename):
+        FileTamper.drop_record(filename)
+        try:
+            os.remove(FileTamper._get_manifest_filename(filename))
+        except OSError:
+            pass
+
+    @staticmethod
+    def feed_prefix(filename, length, sinks, buf):
+        # Replays the first length bytes of a file into hash sinks, used when
+        # an upload resumes without the hash state of its first part.
+        mv = memoryview(buf)
+        with open(filename, "rb") as f:
+            while length:
+                n = f.readinto(mv[:min(len(buf), length)])
+                if not n:
+                    raise OSError("file shorter than restart offset")
+                for sink in sinks:
+                    sink.update(mv[:n])
+                length -= n
+
+    @staticmethod
+    def new_hash():
+        try:
+            return hashlib.md5()
+        except AttributeError:
             try:
-                hash_obj = hashlib.md5()
+                return hashlib.sha1()
             except AttributeError:
-                try:
-                    hash_obj = hashlib.sha1()
-                except AttributeError:
-                    hash_obj = hashlib.sha256()
-            
+                return hashlib.sha256()
+
+    @staticmethod
+    def hash_name():
+        # Name (as used by the FTP HASH command) of the algorithm new_hash()
+        # picks, i.e. the one the digest store is kept in.
+        for name, attr in (("MD5", "md5"), ("SHA-1", "sha1")):
+            if hasattr(hashlib, attr):
+                return name
+        return "SHA-256"
+
+    @staticmethod
+    def fresh_digest(filename):
+        # The stored digest, but only while the cache says the file was
+        # recently hashed to that value and has not been touched since.
+        entry = FileTamper._cache.get(filename)
+        if entry is None or entry[0] != entry[1]:
+            return None
+        if ticks_diff(ticks_ms(), entry[3]) >= FileTamper.CACHE_MAX_AGE_MS:
+            return None
+        if FileTamper._stat(filename) != entry[2]:
+            return None
+        return entry[0]
+
+    @staticmethod
+    def note_digest(filename, current_hash):
+        # Records a full-file digest computed elsewhere (in the stored
+        # algorithm) as a fresh check of the file.
+        entry = FileTamper._cache_get(filename)
+        if entry is not None:
+            original_hash = entry[0]
+        else:
+            record = FileTamper.store().get(filename)
+            if record is None:
+                return
+            original_hash = record[0]
+        FileTamper._cache_put(filename, original_hash, current_hash,
+                              FileTamper._stat(filename))
+        FileTamper._report(filename, original_hash, current_hash)
+
+    @staticmethod
+    def hexdigest(hash_obj):
+        return binascii.hexlify(hash_obj.digest()).decode()
+
+    @staticmethod
+    def _compute_hash(filename, builder=None):
+        start = ticks_ms()
+        try:
+            hash_obj = FileTamper.new_hash()
             with open(filename, "rb") as f:
                 while True:
                     chunk = f.read(512)
                     if not chunk:
                         break
                     hash_obj.update(chunk)
-            
-            return binascii.hexlify(hash_obj.digest()).decode()
+                    if builder is not None:
+                        builder.update(chunk)
+            if builder is not None:
+                builder.finish()
+
+            Metrics.observe("hash_ms", ticks_diff(ticks_ms(), start))
+            return FileTamper.hexdigest(hash_obj)
         except Exception as e:
+            if builder is not None:
+                builder.abort()
             Logger.log_alert(f"Hash computation error for {filename}: {e}")
             return None
 
     @staticmethod
     def init_file_hash(filename):
-        FileTamper._ensure_hash_dir()
-        current_hash = FileTamper._compute_hash(filename)
+        builder = FileTamper.manifest_builder(filename)
+        current_hash = FileTamper._compute_hash(filename, builder)
         if current_hash is None:
             return False
-            
-        hash_file = FileTamper._get_hash_filename(filename)
+        return FileTamper.save_hash(filename, current_hash,
+                                    builder.root if builder is not None else None)
+
+    @staticmethod
+    def save_hash(filename, current_hash, root=None):
+        store = FileTamper.store()
+        stat = FileTamper._stat(filename) or (0, 0)
         try:
-            with open(hash_file, "w") as f:
-                f.write(current_hash)
-            Logger.log_info(f"Saved hash for {filename} in {hash_file}")
+            store.put(filename, current_hash, root, stat[0], stat[1])
+            FileTamper._cache_put(filename, current_hash, current_hash, stat)
+            Logger.log_info(f"Saved hash for {filename} in {store.path}")
             return True
         except Exception as e:
             Logger.log_alert(f"Error saving hash for {filename}: {e}")
             return False
 
     @staticmethod
-    def check_file_changed(filename):
-        FileTamper._ensure_hash_dir()
-        hash_file = FileTamper._get_hash_filename(filename)
-        
-        try:
-            with open(hash_file, "r") as f:
-                original_hash = f.read().strip()
-        except OSError:
-            Logger.log_alert(f"No hash found for {filename}")
-            return False
-            
-        current_hash = FileTamper._compute_hash(filename)
+    def _cached_check(filename):
+        # (verdict, original_hash, stat): verdict is set when the cache can
+        # answer or there is nothing to compare against; otherwise the file
+        # has to be hashed and compared with original_hash.
+        stat = FileTamper._stat(filename)
+        entry = FileTamper._cache_get(filename)
+        if entry is not None:
+            original_hash = entry[0]
+            if (stat is not None and entry[2] == stat
+                    and ticks_diff(ticks_ms(), entry[3]) < FileTamper.CACHE_MAX_AGE_MS):
+                return FileTamper._report(filename, original_hash, entry[1]), original_hash, stat
+        else:
+            record = FileTamper.store().get(filename)
+            if record is None:
+                Logger.log_alert(f"No hash found for {filename}")
+                return False, None, stat
+            original_hash = record[0]
+        return None, original_hash, stat
+
+    @staticmethod
+    def _checked(filename, original_hash, current_hash, stat):
         if current_hash is None:
+            FileTamper.forget(filename)
             return False
-            
+        FileTamper._cache_put(filename, original_hash, current_hash, stat)
+        return FileTamper._report(filename, original_hash, current_hash)
+
+    @staticmethod
+    def check_file_changed(filename):
+        verdict, original_hash, stat = FileTamper._cached_check(filename)
+        if verdict is not None:
+            return verdict
+        current_hash = FileTamper._compute_hash(filename)
+        return FileTamper._checked(filename, original_hash, current_hash, stat)
+
+    @staticmethod
+    async def check_file_changed_async(filename, buf, worker=None, buf2=None):
+        # Same check without blocking the event loop: the file is read one
+        # buffer at a time, and hashed on the worker when one is given.
+        verdict, original_hash, stat = FileTamper._cached_check(filename)
+        if verdict is not None:
+            return verdict
+        start = ticks_ms()
+        hash_obj = FileTamper.new_hash()
+        try:
+            with open(filename, "rb") as f:
+                await hash_file(f, hash_obj, buf, 0, None, worker, buf2)
+            current_hash = FileTamper.hexdigest(hash_obj)
+            Metrics.observe("hash_ms", ticks_diff(ticks_ms(), start))
+        except Exception as e:
+            Logger.log_alert(f"Hash computation error for {filename}: {e}")
+            current_hash = None
+        return FileTamper._checked(filename, original_hash, current_hash, stat)
+
+    @staticmethod
+    def _report(filename, original_hash, current_hash):
         if current_hash != original_hash:
             Logger.log_alert(f"FILE '{filename}' HAS BEEN MODIFIED! (MD5: {original_hash} -> {current_hash})")
             return True
             
-        return False
\ No newline at end of file
+        return False
+
+
+def _parents(nodes):
+    # An odd node at the end of a level is promoted unchanged.
+    parents = []
+    for i in range(0, len(nodes), 2):
+        if i + 1 < len(nodes):
+            h = FileTamper.new_hash()
+            h.update(nodes[i])
+            h.update(nodes[i + 1])
+            parents.append(h.digest())
+        else:
+            parents.append(nodes[i])
+    return parents
+
+
+class TamperScanner:
+    # Hashes at most BUDGET_BYTES or BUDGET_MS of file data per tick() and
+    # resumes mid-file on the next one, cycling round-robin through the
+    # monitored files (every file in the digest store by default).
+    # cycle_ms is the time the last full pass took, i.e. the worst-case
+    # detection window. tick_async() does the same work with the hashing
+    # on a Worker, reading ASYNC_CHUNK_SIZE blocks into two alternating
+    # buffers.
+    # With a DirtyResolver (fatmap) the scanner stops cycling and only
+    # looks at what the card reports written: changed files are rehashed,
+    # written Merkle leaves of the others are verified in place (or the
+    # whole file is rehashed if it has no manifest or too many leaves were
+    # hit), and a rescan request from the resolver runs one full cycle.
+    BUDGET_BYTES = 16 * 1024
+    BUDGET_MS = 20
+    CHUNK_SIZE = 512
+    ASYNC_CHUNK_SIZE = 4096
+
+    def __init__(self, files=None, budget_bytes=BUDGET_BYTES, budget_ms=BUDGET_MS, resolver=None):
+        self.files = files
+        self.resolver = resolver
+        self.leaf_buf = None
+        self.budget_bytes = budget_bytes
+        self.budget_ms = budget_ms
+        self.buf = bytearray(TamperScanner.CHUNK_SIZE)
+        self.async_bufs = None
+        self.queue = []
+        self.current = None
+        self.stat = None
+        self.offset = 0
+        self.hash_obj = None
+        self.file_ms = 0
+        self.cycle_start = ticks_ms()
+        self.cycle_files = 0
+        self.cycle_ms = None
+        self.cycles = 0
+
+    def _monitored(self):
+        return self.files if self.files is not None else FileTamper.store().index
+
+    def _end_cycle(self):
+        if self.cycle_files:
+            self.cycle_ms = ticks_diff(ticks_ms(), self.cycle_start)
+            self.cycles += 1
+            Metrics.observe("scan_cycle_ms", self.cycle_ms)
+            Logger.log_debug("Tamper scan cycle: %d files in %d ms", self.cycle_files, self.cycle_ms)
+            self.cycle_files = 0
+
+    def _start_cycle(self):
+        self._end_cycle()
+        self.cycle_start = ticks_ms()
+        self.queue = list(self._monitored())
+        self.queue.reverse()
+        self.cycle_files = len(self.queue)
+
+    def _open_next(self):
+        while True:
+            if not self.queue:
+                if self.resolver is not None:
+                    self._end_cycle()
+                    return False
+                self._start_cycle()
+                if not self.queue:
+                    return False
+            path = self.queue.pop()
+            stat = FileTamper._stat(path)
+            if stat is None:
+                Logger.log_alert(f"Monitored file missing: {path}")
+                continue
+            self._restart(path, stat)
+            return True
+
+    def _restart(self, path, stat):
+        self.current = path
+        self.stat = stat
+        self.offset = 0
+        self.file_ms = 0
+        self.hash_obj = FileTamper.new_hash()
+
+    def _next_path(self):
+        # The file to continue hashing, or None when there is nothing to scan.
+        while True:
+            if self.current is None and not self._open_next():
+                return None
+            path = self.current
+            stat = FileTamper._stat(path)
+            if stat == self.stat:
+                return path
+            # Changed since we started hashing it: start this file over.
+            if stat is None:
+                self.current = None
+                continue
+            self._restart(path, stat)
+            return path
+
+    def _enqueue(self, path):
+        # Rehash path from the start, next; data already hashed may be stale.
+        FileTamper.forget(path)
+        if path == self.current:
+            self.current = None
+        if path in self.queue:
+            self.queue.remove(path)
+        self.queue.append(path)
+
+    def _poll(self):
+        if self.resolver is None:
+            return []
+        try:
+            result = self.resolver.poll(self._monitored())
+        except (OSError, ValueError) as e:
+            Logger.log_alert(f"Write tracking error, rescanning: {e}")
+            result = None
+        if result is None:
+            self.current = None
+            self.cycle_files = 0
+            self._start_cycle()
+            return []
+        changed, ranges = result
+        for path in changed:
+            self._enqueue(path)
+        tampered = []
+        leaf_size = FileTamper.LEAF_SIZE
+        for path, written in ranges.items():
+            if path in self.queue:
+                continue
+            spans = []
+            for start, end in written:
+                first = start // leaf_size
+                last = (end - 1) // leaf_size
+                if spans and first <= spans[-1][1] + 1:
+                    spans[-1][1] = max(spans[-1][1], last)
+                else:
+                    spans.append([first, last])
+            record = FileTamper.store().get(path)
+            leaves = sum(last - first + 1 for first, last in spans)
+            if (path == self.current or record is None or record[1] is None
+                    or leaves * leaf_size > self.budget_bytes):
+                self._enqueue(path)
+                continue
+            FileTamper.forget(path)
+            if self.leaf_buf is None:
+                self.leaf_buf = bytearray(leaf_size)
+            Metrics.count("scan_leaves", leaves)
+            for first, last in spans:
+                if not FileTamper.verify_range(path, first, last - first + 1, self.leaf_buf):
+                    tampered.append(path)
+                    break
+        return tampered
+
+    def _file_done(self, path, tampered):
+        self.current = None
+        Metrics.observe("hash_ms", self.file_ms)
+        if self._finish(path):
+            tampered.append(path)
+
+    def tick(self):
+        start = ticks_ms()
+        done = 0
+        tampered = self._poll()
+        mv = memoryview(self.buf)
+        size = len(self.buf)
+        while done < self.budget_bytes and ticks_diff(ticks_ms(), start) < self.budget_ms:
+            path = self._next_path()
+            if path is None:
+                break
+            eof = False
+            slice_start = ticks_ms()
+            try:
+                with open(path, "rb") as f:
+                    f.seek(self.offset)
+                    while done < self.budget_bytes and ticks_diff(ticks_ms(), start) < self.budget_ms:
+                        n = f.readinto(mv)
+                        if not n:
+                            eof = True
+                            break
+                        self.hash_obj.update(mv if n == size else mv[:n])
+                        self.offset += n
+                        done += n
+            except OSError as e:
+                Logger.log_alert(f"Hash computation error for {path}: {e}")
+                self.current = None
+                continue
+            self.file_ms += ticks_diff(ticks_ms(), slice_start)
+            if eof:
+                self._file_done(path, tampered)
+        if done:
+            Metrics.count("scan_bytes", done)
+        return tampered
+
+    async def tick_async(self, worker):
+        if self.async_bufs is None:
+            self.async_bufs = (bytearray(TamperScanner.ASYNC_CHUNK_SIZE),
+                               bytearray(TamperScanner.ASYNC_CHUNK_SIZE))
+        done = 0
+        tampered = self._poll()
+        while done < self.budget_bytes:
+            path = self._next_path()
+            if path is None:
+                break
+            want = self.budget_bytes - done
+            slice_start = ticks_ms()
+            try:
+                with open(path, "rb") as f:
+                    n = await hash_file(f, self.hash_obj, self.async_bufs[0], self.offset,
+                                        want, worker, self.async_bufs[1])
+            except OSError as e:
+                Logger.log_alert(f"Hash computation error for {path}: {e}")
+                self.current = None
+                continue
+            self.file_ms += ticks_diff(ticks_ms(), slice_start)
+            self.offset += n
+            done += n
+            if n < want and self.current == path:
+                self._file_done(path, tampered)
+        if done:
+            Metrics.count("scan_bytes", done)
+        return tampered
+
+    def _finish(self, path):
+        record = FileTamper.store().get(path)
+        if record is None:
+            return False
+        current_hash = FileTamper.hexdigest(self.hash_obj)
+        FileTamper._cache_put(path, record[0], current_hash, self.stat)
+        return FileTamper._report(path, record[0], current_hash)
+
+
+class DigestStore:
+    # All known digests in one file of fixed-size records, held in RAM as a
+    # single bytearray with a path -> slot index. Every change rewrites the
+    # file to a temporary name and renames it over the old one.
+    def __init__(self, path):
+        self.path = path
+        self.records = bytearray()
+        self.index = {}
+
+    def load(self):
+        self.records = bytearray()
+        self.index = {}
+        try:
+            with open(self.path, "rb") as f:
+                magic, record_size, count = struct.unpack(
+                    _STORE_HEADER, f.read(_STORE_HEADER_SIZE))
+                if magic != _STORE_MAGIC or record_size != _STORE_RECORD_SIZE:
+                    raise ValueError("bad digest store header")
+                self.records = bytearray(f.read(count * record_size))
+        except OSError:
+            return
+        except Exception as e:
+            Logger.log_alert(f"Ignoring corrupt digest store {self.path}: {e}")
+            return
+        for slot in range(len(self.records) // _STORE_RECORD_SIZE):
+            path = struct.unpack_from("64s", self.records, slot * _STORE_RECORD_SIZE)[0]
+            self.index[path.rstrip(b"\0").decode()] = slot
+
+    def get(self, path):
+        slot = self.index.get(path)
+        if slot is None:
+            return None
+        _, dlen, digest, root, size, mtime = struct.unpack_from(
+            _STORE_RECORD, self.records, slot * _STORE_RECORD_SIZE)
+        root = root[:dlen] if any(root) else None
+        return (binascii.hexlify(digest[:dlen]).decode(), root, size, mtime)
+
+    def put(self, path, digest, root, size, mtime):
+        encoded = path.encode()
+        if len(encoded) > 64:
+            raise ValueError("path too long for digest store")
+        digest = binascii.unhexlify(digest)
+        slot = self.index.get(path)
+        if slot is None:
+            slot = len(self.records) // _STORE_RECORD_SIZE
+            self.records.extend(bytes(_STORE_RECORD_SIZE))
+            self.index[path] = slot
+        struct.pack_into(_STORE_RECORD, self.records, slot * _STORE_RECORD_SIZE,
+                         encoded, len(digest), digest, root or b"", size, mtime)
+        self.save()
+
+    def remove(self, path):
+        slot = self.index.pop(path, None)
+        if slot is None:
+            return
+        last = len(self.records) // _STORE_RECORD_SIZE - 1
+        if slot != last:
+            start = last * _STORE_RECORD_SIZE
+            self.records[slot * _STORE_RECORD_SIZE:(slot + 1) * _STORE_RECORD_SIZE] = \
+                self.records[start:start + _STORE_RECORD_SIZE]
+            moved = struct.unpack_from("64s", self.records, slot * _STORE_RECORD_SIZE)[0]
+            self.index[moved.rstrip(b"\0").decode()] = slot
+        self.records = self.records[:last * _STORE_RECORD_SIZE]
+        self.save()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(struct.pack(_STORE_HEADER, _STORE_MAGIC, _STORE_RECORD_SIZE,
+                                len(self.records) // _STORE_RECORD_SIZE))
+            f.write(self.records)
+        os.rename(tmp, self.path)
+
+
+class MerkleBuilder:
+    def __init__(self, path, leaf_size):
+        self.path = path
+        self.leaf_size = leaf_size
+        self.f = open(path, "w+b")
+        self.f.write(bytes(_MANIFEST_HEADER_SIZE))
+        self.leaf = FileTamper.new_hash()
+        self.fill = 0
+        self.size = 0
+        self.nleaves = 0
+        self.root = None
+
+    def update(self, data):
+        mv = memoryview(data)
+        pos = 0
+        end = len(mv)
+        while pos < end:
+            take = min(self.leaf_size - self.fill, end - pos)
+            self.leaf.update(mv[pos:pos + take])
+            self.fill += take
+            pos += take
+            if self.fill == self.leaf_size:
+                self._push_leaf()
+        self.size += end
+
+    def _push_leaf(self):
+        self.f.write(self.leaf.digest())
+        self.nleaves += 1
+        self.leaf = FileTamper.new_hash()
+        self.fill = 0
+
+    def finish(self):
+        if self.fill or not self.nleaves:
+            self._push_leaf()
+        f = self.f
+        dsize = len(self.leaf.digest())
+        offset = _MANIFEST_HEADER_SIZE
+        count = self.nleaves
+        end = offset + count * dsize
+        pair = bytearray(2 * dsize)
+        while count > 1:
+            for i in range(0, count, 2):
+                f.seek(offset + i * dsize)
+                if i + 1 < count:
+                    f.readinto(pair)
+                    node = FileTamper.new_hash()
+                    node.update(pair)
+                    parent = node.digest()
+                else:
+                    parent = f.read(dsize)
+                f.seek(end)
+                f.write(parent)
+                end += dsize
+            offset += count * dsize
+            count = (count + 1) // 2
+        f.seek(end - dsize)
+        self.root = f.read(dsize)
+        f.seek(0)
+        f.write(struct.pack(_MANIFEST_HEADER, _MANIFEST_MAGIC, dsize, 0,
+                            self.leaf_size, self.size, self.nleaves))
+        f.close()
+        return self.root
+
+    def abort(self):
+        try:
+            self.f.close()
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class MerkleManifest:
+    def __init__(self, f, digest_size, leaf_size, file_size, nleaves):
+        self.f = f
+        self.digest_size = digest_size
+        self.leaf_size = leaf_size
+        self.file_size = file_size
+        self.nleaves = nleaves
+        self.levels = []
+        offset = _MANIFEST_HEADER_SIZE
+        count = nleaves
+        while True:
+            self.levels.append((offset, count))
+            if count == 1:
+                break
+            offset += count * digest_size
+            count = (count + 1) // 2
+
+    @staticmethod
+    def open(path):
+        f = open(path, "rb")
+        try:
+            magic, dsize, _, leaf_size, file_size, nleaves = struct.unpack(
+                _MANIFEST_HEADER, f.read(_MANIFEST_HEADER_SIZE))
+            if magic != _MANIFEST_MAGIC or not nleaves:
+                raise ValueError("bad manifest header")
+        except Exception:
+            f.close()
+            raise
+        return MerkleManifest(f, dsize, leaf_size, file_size, nleaves)
+
+    def close(self):
+        self.f.close()
+
+    def node(self, level, index):
+        offset = self.levels[level][0]
+        self.f.seek(offset + index * self.digest_size)
+        return self.f.read(self.digest_size)
+
+    def root(self):
+        return self.node(len(self.levels) - 1, 0)
+
+    def leaf_length(self, index):
+        return min(self.leaf_size, self.file_size - index * self.leaf_size)
+
+    def _fold(self, level, first, nodes):
+        # Combine a run of nodes on one level up to the root, reading only the
+        # sibling digests that border the run from the manifest.
+        while level < len(self.levels) - 1:
+            count = self.levels[level][1]
+            if first % 2:
+                first -= 1
+                nodes.insert(0, self.node(level, first))
+            last = first + len(nodes)
+            if last % 2 and last < count:
+                nodes.append(self.node(level, last))
+            nodes = _parents(nodes)
+            first //= 2
+            level += 1
+        return nodes[0]
+
+    def verify_tree(self):
+        # Leaves are read in bounded batches, each batch folded to its subtree
+        # root, so memory stays flat regardless of file size.
+        batch = 64
+        nodes = []
+        for first in range(0, self.nleaves, batch):
+            count = min(batch, self.nleaves - first)
+            self.f.seek(self.levels[0][0] + first * self.digest_size)
+            leaves = [self.f.read(self.digest_size) for _ in range(count)]
+            nodes.append(self._subtree_root(leaves))
+        if len(nodes) == 1:
+            return nodes[0] == self.root()
+        level = 0
+        span = batch
+        while span > 1:
+            span //= 2
+            level += 1
+        return self._fold(level, 0, nodes) == self.root()
+
+    def _subtree_root(self, nodes):
+        while len(nodes) > 1:
+            nodes = _parents(nodes)
+        return nodes[0]
+
+    def verify_range(self, f, first, count, buf=None):
+        count = min(count, self.nleaves - first)
+        if buf is None:
+            buf = bytearray(self.leaf_size)
+        mv = memoryview(buf)
+        digests = []
+        for index in range(first, first + count):
+            length = self.leaf_length(index)
+            f.seek(index * self.leaf_size)
+            if f.readinto(mv[:length]) != length:
+                return index
+            h = FileTamper.new_hash()
+            h.update(mv[:length])
+            digest = h.digest()
+            if digest != self.node(0, index):
+                return index
+            digests.append(digest)
+        if digests and self._fold(0, first, digests) != self.root():
+            return first
+        return -1
+
+    def verifier(self):
+        return MerkleVerifier(self)
+
+
+class MerkleVerifier:
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.leaf = FileTamper.new_hash()
+        self.fill = 0
+        self.index = 0
+        self.size = 0
+
+    def seek(self, offset):
+        # Continue verification from the leaf containing offset; returns the
+        # file position to start reading from.
+        self.index = offset // self.manifest.leaf_size
+        self.size = self.index * self.manifest.leaf_size
+        return self.size
+
+    def update(self, data):
+        mv = memoryview(data)
+        leaf_size = self.manifest.leaf_size
+        pos = 0
+        end = len(mv)
+        while pos < end:
+            take = min(leaf_size - self.fill, end - pos)
+            self.leaf.update(mv[pos:pos + take])
+            self.fill += take
+            pos += take
+            if self.fill == leaf_size:
+                self._check_leaf()
+        self.size += end
+
+    def _check_leaf(self):
+        m = self.manifest
+        if self.index >= m.nleaves or self.leaf.digest() != m.node(0, self.index):
+            raise TamperError(f"block {self.index} does not match manifest")
+        self.index += 1
+        self.leaf = FileTamper.new_hash()
+        self.fill = 0
+
+    def finish(self):
+        if self.fill or not self.index:
+            self._check_leaf()
+        if self.size != self.manifest.file_size or self.index != self.manifest.nleaves:
+            raise TamperError("file length does not match manifest")
@@ -0,0 +1,270 @@
+"""
+Streaming data-channel transfers on preallocated buffers.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+from utils import ticks_ms, ticks_diff
+
+SECTOR_SIZE = 512
+DEFAULT_BLOCK_SIZE = 4096
+DEFAULT_PIPELINE_DEPTH = 2
+
+
+def check_block_size(block_size):
+    if block_size <= 0 or block_size % SECTOR_SIZE:
+        raise ValueError("block size must be a multiple of %d" % SECTOR_SIZE)
+    return block_size
+
+
+def rate(nbytes, elapsed_ms):
+    return nbytes * 1000 // max(elapsed_ms, 1)
+
+
+async def send_all(writer, mv):
+    # write() pushes as much as the socket takes and keeps only the unsent
+    # tail; drain() keeps retrying that tail until it is gone, so once it
+    # returns the caller may refill the buffer behind mv.
+    writer.write(mv)
+    await writer.drain()
+
+
+class Pipeline:
+    # depth preallocated buffers rotate between a producer task and the
+    # consumer (the calling task): for RETR the producer reads the card and
+    # the consumer sends, for STOR the producer receives and the consumer
+    # writes the card. Whichever side waits on the socket lets the other
+    # one work on the card in the meantime. A side that finds no buffer
+    # ready counts a stall of the device on the other side: stalls["sd"]
+    # and stalls["net"] hold [count, ms] for the last run. With depth 1
+    # there is nothing to overlap and both run in turn in the calling task.
+    def __init__(self, depth=DEFAULT_PIPELINE_DEPTH, size=DEFAULT_BLOCK_SIZE):
+        if depth < 1:
+            raise ValueError("pipeline depth must be at least 1")
+        self.depth = depth
+        self.size = check_block_size(size)
+        self.bufs = [bytearray(size) for _ in range(depth)]
+        self.views = [memoryview(b) for b in self.bufs]
+        self.stalls = {"sd": [0, 0], "net": [0, 0]}
+        self.free = []
+        self.full = []
+        self.ended = False
+        self.error = None
+        self.filled = None
+        self.emptied = None
+
+    async def _wait(self, items, event, device):
+        start = ticks_ms()
+        while not items and not self.ended:
+            event.clear()
+            await event.wait()
+        stall = self.stalls[device]
+        stall[0] += 1
+        stall[1] += ticks_diff(ticks_ms(), start)
+
+    async def _produce(self, produce, device):
+        try:
+            while True:
+                if not self.free:
+                    await self._wait(self.free, self.emptied, device)
+                i = self.free.pop(0)
+                chunk = await produce(self.views[i])
+                if not chunk:
+                    break
+                self.full.append((i, chunk))
+                self.filled.set()
+        except Exception as e:
+            self.error = e
+        self.ended = True
+        self.filled.set()
+
+    async def run(self, produce, consume, producer_device, consumer_device):
+        # produce(mv) fills a free buffer and returns the part to pass on
+        # (a slice of mv), or nothing at the end; consume(chunk) must be
+        # done with the chunk when it returns. Errors from the producer are
+        # raised here once everything it produced has been consumed.
+        self.free = list(range(self.depth))
+        self.full = []
+        self.ended = False
+        self.error = None
+        self.filled = asyncio.Event()
+        self.emptied = asyncio.Event()
+        for stall in self.stalls.values():
+            stall[0] = stall[1] = 0
+        if self.depth == 1:
+            while True:
+                chunk = await produce(self.views[0])
+                if not chunk:
+                    return
+                await consume(chunk)
+        task = asyncio.create_task(self._produce(produce, consumer_device))
+        try:
+            while True:
+                if not self.full:
+                    if self.ended:
+                        break
+                    await self._wait(self.full, self.filled, producer_device)
+                    continue
+                i, chunk = self.full.pop(0)
+                await consume(chunk)
+                self.free.append(i)
+                self.emptied.set()
+        finally:
+            if not self.ended:
+                task.cancel()
+        if self.error is not None:
+            raise self.error
+
+
+async def send_file(f, writer, pipe, verifier=None, offset=0):
+    # With a verifier each block is checked before it is handed to the
+    # sender, so a mismatch aborts the transfer before any tampered byte is
+    # sent. A restart offset inside a verified block is reached by reading
+    # and verifying from the start of that block and dropping the bytes
+    # before the offset.
+    skip = 0
+    if offset:
+        pos = verifier.seek(offset) if verifier is not None else offset
+        skip = offset - pos
+        f.seek(pos)
+    total = 0
+
+    async def read(mv):
+        nonlocal skip
+        while True:
+            n = f.readinto(mv)
+            if not n:
+                if verifier is not None:
+                    verifier.finish()
+                return None
+            chunk = mv if n == len(mv) else mv[:n]
+            if verifier is not None:
+                verifier.update(chunk)
+            if skip < n:
+                chunk = chunk[skip:]
+                skip = 0
+                return chunk
+            skip -= n
+
+    async def send(chunk):
+        nonlocal total
+        await send_all(writer, chunk)
+        total += len(chunk)
+
+    start = ticks_ms()
+    await pipe.run(read, send, "sd", "net")
+    return total, ticks_diff(ticks_ms(), start)
+
+
+async def send_lines(writer, lines, buf):
+    # Packs the lines, CRLF-terminated, into buf and sends it whenever the
+    # next one does not fit, so a long listing is never built as one string.
+    mv = memoryview(buf)
+    size = len(buf)
+    fill = 0
+    total = 0
+    for line in lines:
+        data = line.encode()
+        n = len(data) + 2
+        if fill + n > size:
+            if fill:
+                await send_all(writer, mv[:fill])
+                total += fill
+                fill = 0
+            if n > size:
+                await send_all(writer, data + b"\r\n")
+                total += n
+                continue
+        mv[fill:fill + n - 2] = data
+        mv[fill + n - 2:fill + n] = b"\r\n"
+        fill += n
+    if fill:
+        await send_all(writer, mv[:fill])
+        total += fill
+    return total
+
+
+async def hash_file(f, hash_obj, buf, start=0, length=None, worker=None, buf2=None):
+    # Feeds [start, start + length) of f (to the end when length is None) to
+    # hash_obj, yielding to other sessions after every block; returns the
+    # number of bytes hashed. With a worker and a second buffer the two
+    # buffers alternate: the next block is read here while the worker hashes
+    # the previous one.
+    bufs = (memoryview(buf), memoryview(buf2 if buf2 is not None else buf))
+    pipelined = worker is not None and buf2 is not None
+    job = None
+    i = 0
+    total = 0
+    f.seek(start)
+    while length is None or length > 0:
+        mv = bufs[i]
+        want = len(mv) if length is None else min(len(mv), length)
+        n = f.readinto(mv[:want])
+        if job is not None:
+            await job.wait()
+            job = None
+        if not n:
+            break
+        if pipelined:
+            job = await worker.submit(hash_obj.update, mv[:n])
+            i ^= 1
+        else:
+            hash_obj.update(mv[:n])
+        total += n
+        if length is not None:
+            length -= n
+        await asyncio.sleep(0)
+    if job is not None:
+        await job.wait()
+    return total
+
+
+async def recv_into(reader, mv):
+    readinto = getattr(reader, "readinto", None)
+    if readinto is not None:
+        return await readinto(mv)
+    # CPython StreamReader has no readinto()
+    data = await reader.read(len(mv))
+    n = len(data)
+    mv[:n] = data
+    return n
+
+
+async def recv_file(reader, f, pipe, sinks=()):
+    # Blocks go to the card only once a buffer is full, so every write but
+    # the last covers whole sectors; each sink (hash object, manifest
+    # builder) sees exactly what was written.
+    # Whatever arrived before a connection error is still written out, so
+    # f.tell() after a failure is exactly what the sinks have seen.
+    failed = None
+    total = 0
+
+    async def receive(mv):
+        nonlocal failed
+        if failed is not None:
+            raise failed
+        fill = 0
+        try:
+            while fill < len(mv):
+                n = await recv_into(reader, mv[fill:])
+                if not n:
+                    break
+                fill += n
+        except Exception as e:
+            if not fill:
+                raise
+            failed = e
+        return mv[:fill] if fill else None
+
+    async def write(chunk):
+        nonlocal total
+        f.write(chunk)
+        for sink in sinks:
+            sink.update(chunk)
+        total += len(chunk)
+
+    start = ticks_ms()
+    await pipe.run(receive, write, "net", "sd")
+    return total, ticks_diff(ticks_ms(), start)
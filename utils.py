@@ -1,5 +1,4 @@
 # utils.py
-from logger import Logger
 
 def load_env(filepath=".env"):
     env = {}
@@ -11,5 +10,17 @@ def load_env(filepath=".env"):
                     key, value = line.split("=", 1)
                     env[key.strip()] = value.strip()
     except OSError:
+        from logger import Logger
         Logger.log_alert(".env file not found! Using default values.")
     return env
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(end, start):
+        return end - start
@@ -0,0 +1,111 @@
+"""
+Background worker thread (core 1 on the RP2040) for CPU-bound jobs such as hashing.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+QUEUE_SIZE = 8
+POLL_S = 0.002
+
+
+class Job:
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = False
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done = True
+
+    async def wait(self):
+        # Polled rather than signalled: asyncio events cannot be set from
+        # another thread on either port.
+        while not self.done:
+            await asyncio.sleep(POLL_S)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Worker:
+    # Jobs go through a lock-protected FIFO of at most queue_size entries and
+    # run one at a time, in order, on the worker thread. The worker never
+    # touches the filesystem itself: FatFs is not reentrant, so callers read
+    # on the main core and hand the worker buffers to hash. Without _thread,
+    # or before start(), jobs run inline when submitted.
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.jobs = []
+        self.lock = _thread.allocate_lock() if _thread else None
+        self.wakeup = _thread.allocate_lock() if _thread else None
+        self.running = False
+        self.completed = 0
+        self.busy_waits = 0
+
+    def start(self):
+        if _thread is None or self.running:
+            return self.running
+        self.wakeup.acquire()
+        self.running = True
+        _thread.start_new_thread(self._loop, ())
+        return True
+
+    def stop(self):
+        self.running = False
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wakeup.release()
+        except RuntimeError:
+            pass
+
+    def _loop(self):
+        while self.running:
+            with self.lock:
+                job = self.jobs.pop(0) if self.jobs else None
+            if job is None:
+                self.wakeup.acquire()
+                continue
+            job.run()
+            self.completed += 1
+
+    async def submit(self, fn, *args):
+        job = Job(fn, args)
+        if not self.running:
+            job.run()
+            return job
+        while True:
+            with self.lock:
+                if len(self.jobs) < self.queue_size:
+                    self.jobs.append(job)
+                    break
+            self.busy_waits += 1
+            await asyncio.sleep(POLL_S)
+        self._wake()
+        return job
+
+    async def call(self, fn, *args):
+        job = await self.submit(fn, *args)
+        return await job.wait()
+
+    def stats(self):
+        return {
+            "running": int(self.running),
+            "queued": len(self.jobs),
+            "completed": self.completed,
+            "busy_waits": self.busy_waits,
+        }